@@ -17,7 +17,7 @@ from app.models.user import User
 from app.db.mongo import MongoDB, get_mongo
 from app.core.security import get_current_user, verify_username_match
 from app.rag.convert_file import (
-    save_file_to_minio,
+    save_files_to_minio,
 )
 from app.utils.kafka_producer import kafka_producer_manager
 from app.core.logging import logger
@@ -308,28 +308,24 @@ async def upload_multiple_files(
     )
     await redis_connection.expire(f"task:{task_id}", 3600)  # 1小时过期
 
-    # 保存文件元数据并准备Kafka消息
-    file_meta_list = []
-    for file in files:
-        # 保存文件到MinIO
-        minio_filename, minio_url = await save_file_to_minio(username, file)
+    # 并发保存文件到MinIO
+    saved_files = await save_files_to_minio(username, files)
 
-        # 生成文件ID并保存元数据
+    # 生成文件ID并批量保存元数据，准备Kafka消息
+    file_meta_list = []
+    file_records = []
+    for file, (minio_filename, minio_url) in zip(files, saved_files):
         file_id = f"{username}_{uuid.uuid4()}"
-        await db.create_files(
-            file_id=file_id,
-            username=username,
-            filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
-            knowledge_db_id=knowledge_db_id,
-        )
-        await db.knowledge_base_add_file(
-            knowledge_base_id=knowledge_db_id,
-            file_id=file_id,
-            original_filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
+        file_records.append(
+            {
+                "file_id": file_id,
+                "username": username,
+                "filename": file.filename,
+                "original_filename": file.filename,
+                "minio_filename": minio_filename,
+                "minio_url": minio_url,
+                "knowledge_db_id": knowledge_db_id,
+            }
         )
         file_meta_list.append(
             {
@@ -346,19 +342,20 @@ async def upload_multiple_files(
                 "url": minio_url,
             }
         )
+    await db.create_files_bulk(file_records)
+    await db.knowledge_base_add_files(knowledge_db_id, file_records)
 
-    # 发送Kafka消息（每个文件一个消息）
-    for meta in file_meta_list:
-        logger.info(
-            "send {task_id} to kafka, file name {file.filename}, knowledge id {knowledge_db_id}."
-        )
-        await kafka_producer_manager.send_embedding_task(
-            task_id=task_id,
-            username=username,
-            knowledge_db_id=knowledge_db_id,
-            file_meta=meta,
-            priority=1,
-        )
+    # 发送Kafka消息（每个文件一个消息，批量发送）
+    logger.info(
+        f"send {task_id} to kafka, {len(file_meta_list)} files, knowledge id {knowledge_db_id}."
+    )
+    await kafka_producer_manager.send_embedding_tasks(
+        task_id=task_id,
+        username=username,
+        knowledge_db_id=knowledge_db_id,
+        file_metas=file_meta_list,
+        priority=1,
+    )
 
     return {
         "task_id": task_id,
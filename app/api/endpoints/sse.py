@@ -57,6 +57,8 @@ async def get_task_progress(
             status = task_data.get("status", "unknown")
             total = int(task_data.get("total", 0))
             processed = int(task_data.get("processed", 0))
+            pages_total = int(task_data.get("pages_total", 0))
+            pages_processed = int(task_data.get("pages_processed", 0))
             message = task_data.get("message", "")
 
             payload = json.dumps(
@@ -66,6 +68,8 @@ async def get_task_progress(
                     "progress": f"{(processed/total)*100:.1f}" if total > 0 else 0,
                     "processed": processed,
                     "total": total,
+                    "pages_processed": pages_processed,
+                    "pages_total": pages_total,
                     "message": message,
                 }
             )
@@ -1,3 +1,4 @@
+from typing import List
 from pydantic_settings import BaseSettings
 
 
@@ -14,6 +15,7 @@ class Settings(BaseSettings):
     redis_token_db: int = 0  # 用于token存储
     redis_task_db: int = 1  # 用于存储embedding任务队列
     redis_lock_db: int = 2  # 用于存储embedding任务队列
+    redis_embedding_cache_db: int = 3  # 用于缓存查询 embedding
     secret_key: str = "your_secret_key"
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 60 * 24 * 8  # 8 days
@@ -27,13 +29,76 @@ class Settings(BaseSettings):
     kafka_broker_url: str = "localhost:9094"
     kafka_topic: str = "task_generation"
     kafka_group_id: str = "task_consumer_group"
+    kafka_linger_ms: int = 20  # 生产者攒批等待时间（毫秒）
+    kafka_compression_type: str = "gzip"  # 生产者压缩方式（lz4/zstd 需要额外依赖）
+    kafka_max_batch_size: int = 1024 * 1024  # 生产者单个分区批次的最大字节数
+    kafka_priority_topic: str = "task_generation_priority"  # 高优先级（会话临时文件）任务 topic
+    kafka_priority_group_id: str = "task_consumer_group_priority"  # 高优先级通道的消费组（与普通通道分开，互不触发重平衡）
+    kafka_priority_max_in_flight: int = 2  # 高优先级通道同时处理的消息数
+    kafka_lane_metrics_interval: float = 60  # 输出各通道积压深度的间隔（秒）
+    api_consume_tasks: bool = True  # API 进程是否同时消费文件解析任务（独立 worker 部署时设为 False）
+    worker_thread_pool_size: int = 16  # 独立 worker 的线程池大小
+    kafka_max_in_flight: int = 4  # 单个消费者同时处理的消息数
+    kafka_partition_ordering: bool = False  # 是否保证同一分区内按顺序处理
+    kafka_max_retries: int = 2  # 消息处理失败后的重试次数
+    kafka_message_lock_timeout: int = 3600  # 消息处理锁的过期时间（秒）
+    kafka_max_poll_interval_ms: int = 3600 * 1000  # 两次拉取消息的最大间隔
+    kafka_drain_timeout: float = 300  # 停止时等待处理中消息完成的最长时间（秒）
     # kafka_priority_levels: int = 5  # 定义优先级的级别（0为最高）
     minio_url: str = "http://localhost:9110"  # MinIO 服务的URL
     minio_access_key: str = "your_access_key"  # MinIO 的访问密钥
     minio_secret_key: str = "your_secret_key"  # MinIO 的密钥
     minio_bucket_name: str = "ai-chat"  # 需要上传的桶的名称
+    minio_max_pool_connections: int = 50  # MinIO 客户端连接池大小
+    minio_max_retries: int = 3  # MinIO 请求失败的最大重试次数
+    minio_presigned_url_cache_size: int = 10000  # 预签名 URL 缓存条目数
+    prompt_image_fetch_concurrency: int = 10  # 组装 prompt 时并发下载的图片数
+    page_image_cache_bytes: int = 256 * 1024 * 1024  # 热点页面图片内存缓存的字节上限
+    page_image_cache_dir: str = ""  # 页面图片磁盘缓存目录，为空时不启用磁盘缓存
+    page_image_cache_disk_bytes: int = 2 * 1024 * 1024 * 1024  # 磁盘缓存的字节上限
+    minio_upload_concurrency: int = 8  # 单个文件的页面图片并发上传数
+    minio_file_upload_concurrency: int = 4  # 单次请求中多个文件的并发上传数
+    minio_multipart_chunk_size: int = 8 * 1024 * 1024  # 分片上传的分片大小（至少 5MB）
     milvus_uri:str ="http://127.0.0.1:19530"
+    milvus_insert_batch_size: int = 8192  # Milvus 批量插入每批的向量行数
     colbert_model_path:str = "/home/liwei/ai/colqwen2.5-v0.2"
+    colbert_max_batch_size: int = 8  # ColQwen 单批次最大图片/查询数量
+    colbert_max_batch_pixels: int = 28 * 28 * 768 * 4  # 单批次图片像素预算
+    model_server_urls: List[str] = ["http://localhost:8005"]  # model_server 副本地址列表
+    model_server_lb_policy: str = "least_outstanding"  # 负载均衡策略: round_robin / least_outstanding
+    model_server_http2: bool = False  # 是否启用 HTTP/2（需要 httpx[http2]）
+    model_server_max_connections: int = 100  # 连接池最大连接数
+    model_server_max_keepalive: int = 20  # 连接池最大 keep-alive 连接数
+    model_server_timeout: float = 120.0  # 请求超时时间（秒），根据文件大小调整
+    model_server_max_failures: int = 3  # 连续失败多少次后熔断该端点
+    model_server_unhealthy_cooldown: float = 30.0  # 熔断冷却时间（秒）
+    embed_text_max_batch_size: int = 32  # /embed_text 微批处理的最大查询数
+    embed_text_max_wait_ms: float = 5  # /embed_text 微批处理的最长等待时间（毫秒）
+    embedding_binary_response: bool = True  # model_server 使用二进制格式返回 embedding
+    embedding_binary_dtype: str = "float32"  # 二进制 embedding 的精度: float32（无损） / float16（有损，体积减半）
+    query_embedding_cache_size: int = 1024  # 进程内查询 embedding LRU 的条目数
+    query_embedding_cache_ttl: int = 3600  # 查询 embedding 缓存过期时间（秒）
+    query_embedding_cache_redis: bool = True  # 是否启用 Redis 二级缓存
+    rasterize_workers: int = 2  # PDF 栅格化进程池大小
+    rasterize_pages_per_chunk: int = 4  # 每个栅格化任务渲染的页数
+    page_image_format: str = "png"  # 页面图片编码格式: png / webp（无损） / jpeg
+    page_image_png_compress_level: int = 1  # PNG 压缩级别（0-9），越小越快
+    page_image_jpeg_quality: int = 90  # JPEG 编码质量
+    page_image_preview_max_edge: int = 0  # 预览图最长边像素，0 表示不生成预览图
+    page_image_preview_quality: int = 75  # 预览图 JPEG 编码质量
+    ingest_queue_size: int = 8  # 文件解析流水线各阶段之间的队列长度
+    ingest_embed_batch_pages: int = 8  # 每次 embed_image 请求的页数
+    ingest_embed_batch_bytes: int = 16 * 1024 * 1024  # 每次 embed_image 请求的图片总字节数上限
+    ingest_embed_concurrency: int = 2  # 并发 embed_image 请求数
+    ingest_insert_concurrency: int = 1  # 并发 Milvus 插入数
+    llm_client_max_clients: int = 32  # 复用的 LLM 客户端（按 model_url + api_key）最大数量
+    llm_client_max_connections: int = 100  # 每个 LLM 客户端的最大连接数
+    llm_client_max_keepalive: int = 20  # 每个 LLM 客户端的最大 keep-alive 连接数
+    llm_client_idle_timeout: float = 300  # LLM 客户端空闲多久后关闭（秒）
+    llm_client_timeout: float = 600  # LLM 请求超时时间（秒）
+    page_vector_store_enabled: bool = True  # 是否启用本地页面向量存储（重排用）
+    page_vector_store_dir: str = "./page_vectors"  # 本地页面向量存储目录
+    page_vector_cache_bytes: int = 512 * 1024 * 1024  # 内存中热点页面向量的字节上限
 
     class Config:
         env_file = ".env"
@@ -1,16 +1,31 @@
-from pymilvus import MilvusClient, DataType
+from pymilvus import Collection, MilvusClient, DataType, connections
 import numpy as np
 import concurrent.futures
+import time
 from app.core.config import settings
+from app.core.logging import logger
+from app.db.page_vector_store import page_vector_store
+
+# 每个页面最多 1000 个 token 向量（与原先单页查询的 limit 一致），
+# Milvus 单次 query 的 limit 上限为 16384，因此一次最多批量查询 16 个页面
+MILVUS_MAX_TOKENS_PER_PAGE = 1000
+MILVUS_QUERY_PAGES_PER_REQUEST = 16
+MILVUS_RERANK_QUERY_WORKERS = 4
+# search_many 中并发检索的集合数量上限
+MILVUS_SEARCH_WORKERS = 10
+# 列式批量插入使用的 ORM 连接别名
+MILVUS_ORM_ALIAS = "layra_bulk_insert"
 
 
 class MilvusManager:
     def __init__(self):
         self.client = MilvusClient(uri=settings.milvus_uri)
+        self._orm_connected = False
 
     def delete_collection(self, collection_name: str):
         if self.client.has_collection(collection_name):
             self.client.drop_collection(collection_name)
+            page_vector_store.delete_collection(collection_name)
             return True
         else:
             return False
@@ -24,6 +39,7 @@ class MilvusManager:
             collection_name=collection_name,
             filter=filter,
         )
+        page_vector_store.delete_files(collection_name, file_ids)
         return res
 
     def check_collection(self, collection_name: str):
@@ -36,6 +52,7 @@ class MilvusManager:
 
         if self.client.has_collection(collection_name):
             self.client.drop_collection(collection_name)
+        page_vector_store.delete_collection(collection_name)
 
         schema = self.client.create_schema(
             auto_id=True,
@@ -78,75 +95,201 @@ class MilvusManager:
 
     def search(self, collection_name, data, topk):
         # Perform a vector search on the collection to find the top-k most similar documents.
+        candidates = self._search_candidates(collection_name, data)
+        pages = list(candidates.values())
+        doc_vecs, offsets = self._fetch_page_vectors(collection_name, pages)
+        scores = self._maxsim(data, doc_vecs, offsets)
+
+        order = np.argsort(-scores, kind="stable")[:topk]
+        # 返回 Top-K 结果，包含所有字段
+        return [
+            {
+                "score": float(scores[i]),
+                "image_id": pages[i]["image_id"],
+                "file_id": pages[i]["file_id"],
+                "page_number": pages[i]["page_number"],
+            }
+            for i in order
+        ]
+
+    def search_many(self, collection_names, data, topk):
+        # Search several collections at once: candidate generation and vector
+        # fetch run concurrently per collection, then a single MaxSim pass
+        # ranks every candidate page and the merged top-k is returned.
+        collection_names = list(dict.fromkeys(collection_names))
+        timings = {name: {} for name in collection_names}
+
+        def search_collection(collection_name):
+            start = time.perf_counter()
+            if not self.check_collection(collection_name):
+                timings[collection_name]["candidates"] = time.perf_counter() - start
+                return [], np.zeros((0, 0), dtype=np.float32), np.zeros(1, np.int64)
+            candidates = self._search_candidates(collection_name, data)
+            fetch_start = time.perf_counter()
+            timings[collection_name]["candidates"] = fetch_start - start
+            pages = list(candidates.values())
+            doc_vecs, offsets = self._fetch_page_vectors(collection_name, pages)
+            timings[collection_name]["fetch"] = time.perf_counter() - fetch_start
+            for page in pages:
+                page["collection_name"] = collection_name
+            return pages, doc_vecs, offsets
+
+        if not collection_names:
+            return {"results": [], "timings": timings}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(collection_names), MILVUS_SEARCH_WORKERS)
+        ) as executor:
+            per_collection = list(executor.map(search_collection, collection_names))
+
+        # 合并所有集合的候选页面，偏移量依次平移
+        rerank_start = time.perf_counter()
+        pages, matrices, offsets = [], [], [np.zeros(1, dtype=np.int64)]
+        for collection_pages, doc_vecs, collection_offsets in per_collection:
+            if not collection_pages:
+                continue
+            pages.extend(collection_pages)
+            if doc_vecs.shape[0]:
+                matrices.append(doc_vecs)
+            offsets.append(collection_offsets[1:] + offsets[-1][-1])
+        offsets = np.concatenate(offsets)
+        doc_vecs = (
+            np.concatenate(matrices) if matrices else np.zeros((0, 0), np.float32)
+        )
+        scores = self._maxsim(data, doc_vecs, offsets)
+        order = np.argsort(-scores, kind="stable")[:topk]
+        rerank_time = time.perf_counter() - rerank_start
+
+        logger.info(
+            f"Milvus search_many over {len(collection_names)} collections, "
+            f"{len(pages)} candidates, rerank {rerank_time:.3f}s, timings {timings}"
+        )
+        return {
+            "results": [
+                {
+                    "score": float(scores[i]),
+                    "image_id": pages[i]["image_id"],
+                    "file_id": pages[i]["file_id"],
+                    "page_number": pages[i]["page_number"],
+                    "collection_name": pages[i]["collection_name"],
+                }
+                for i in order
+            ],
+            "timings": timings,
+            "rerank_time": rerank_time,
+        }
+
+    def _search_candidates(self, collection_name, data):
+        # ANN search for every query token, deduplicated by page.
+        # 集合的 vector 字段是 FLOAT_VECTOR，float16 的查询向量必须先转成 float32
+        data = np.asarray(data, dtype=np.float32)
         search_params = {"metric_type": "IP", "params": {}}
         results = self.client.search(
             collection_name,
             data,
             limit=int(50),
-            output_fields=["vector", "image_id", "page_number", "file_id"],
+            output_fields=["image_id", "page_number", "file_id"],
             search_params=search_params,
         )
-        image_ids = set()
+        # 候选页面去重，同时保留元数据，避免重排时再次查询
+        candidates = {}
         for r_id in range(len(results)):
             for r in range(len(results[r_id])):
-                image_ids.add(results[r_id][r]["entity"]["image_id"])
-
-        scores = []
+                entity = results[r_id][r]["entity"]
+                candidates.setdefault(
+                    entity["image_id"],
+                    {
+                        "image_id": entity["image_id"],
+                        "file_id": entity["file_id"],
+                        "page_number": entity["page_number"],
+                    },
+                )
+        return candidates
 
-        def rerank_single_doc(image_id, data, client, collection_name):
-            # Rerank a single document by retrieving its embeddings and calculating the similarity with the query.
-            doc_colbert_vecs = client.query(
-                collection_name=collection_name,
-                filter=f"image_id in ['{image_id}']",
-                output_fields=["vector", "image_id", "page_number", "file_id"],
-                limit=1000,
+    def _fetch_page_vectors(self, collection_name, pages):
+        # Fetch the token vectors of all candidate pages, from the local page
+        # vector store when possible and with a few bulk queries otherwise.
+        # Returns one contiguous (n_tokens, dim) matrix plus per-page offsets,
+        # page i owns rows offsets[i]:offsets[i + 1].
+        vectors_by_page = page_vector_store.get_many(collection_name, pages)
+        missing = [page for page in pages if page["image_id"] not in vectors_by_page]
+        if missing:
+            fetched = self._query_page_vectors(
+                collection_name, [page["image_id"] for page in missing]
             )
-            # 提取元数据（假设同一 image_id 对应的 file_id 和 page_number 是相同的）
-            if not doc_colbert_vecs:
-                return (
-                    0.0,
-                    {"image_id": image_id, "file_id": None, "page_number": None},
+            for page in missing:
+                page_vecs = fetched.get(page["image_id"])
+                if page_vecs is None:
+                    continue
+                vectors_by_page[page["image_id"]] = page_vecs
+                # 回填本地存储，下次重排直接命中
+                page_vector_store.put(
+                    collection_name, page["file_id"], page["image_id"], page_vecs
                 )
 
-            # 取第一条记录的元数据（假设同一 image_id 的 file_id 和 page_number 一致）
-            metadata = {
-                "image_id": image_id,
-                "file_id": doc_colbert_vecs[0]["file_id"],
-                "page_number": doc_colbert_vecs[0]["page_number"],
-            }
+        offsets = np.zeros(len(pages) + 1, dtype=np.int64)
+        vectors = []
+        for i, page in enumerate(pages):
+            page_vecs = vectors_by_page.get(page["image_id"])
+            if page_vecs is not None:
+                vectors.append(page_vecs)
+            offsets[i + 1] = offsets[i] + (0 if page_vecs is None else len(page_vecs))
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32), offsets
+        return np.concatenate(vectors).astype(np.float32, copy=False), offsets
+
+    def _query_page_vectors(self, collection_name, image_ids):
+        # Query token vectors for many pages with a few chunked requests.
+        chunks = [
+            image_ids[i : i + MILVUS_QUERY_PAGES_PER_REQUEST]
+            for i in range(0, len(image_ids), MILVUS_QUERY_PAGES_PER_REQUEST)
+        ]
 
-            doc_vecs = np.vstack(
-                [doc_colbert_vecs[i]["vector"] for i in range(len(doc_colbert_vecs))]
+        def query_chunk(chunk):
+            filter = "image_id in [" + ", ".join(f"'{i}'" for i in chunk) + "]"
+            return self.client.query(
+                collection_name=collection_name,
+                filter=filter,
+                output_fields=["vector", "image_id"],
+                limit=MILVUS_MAX_TOKENS_PER_PAGE * len(chunk),
             )
-            score = np.dot(data, doc_vecs.T).max(1).sum()
-            return (score, metadata)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=300) as executor:
-            futures = {
-                executor.submit(
-                    rerank_single_doc, image_id, data, self.client, collection_name
-                ): image_id
-                for image_id in image_ids
-            }
-            for future in concurrent.futures.as_completed(futures):
-                score, metadata = future.result()
-                scores.append((score, metadata))  # 保存元数据
 
-        scores.sort(key=lambda x: x[0], reverse=True)
-        # 返回 Top-K 结果，包含所有字段
-        return [
-            {
-                "score": score,
-                "image_id": metadata["image_id"],
-                "file_id": metadata["file_id"],
-                "page_number": metadata["page_number"],
-            }
-            for score, metadata in scores[:topk]
-        ]
+        rows_by_page = {}
+        if chunks:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(chunks), MILVUS_RERANK_QUERY_WORKERS)
+            ) as executor:
+                for rows in executor.map(query_chunk, chunks):
+                    for row in rows:
+                        rows_by_page.setdefault(row["image_id"], []).append(
+                            row["vector"]
+                        )
+        return {
+            image_id: np.asarray(rows, dtype=np.float32)
+            for image_id, rows in rows_by_page.items()
+        }
+
+    @staticmethod
+    def _maxsim(data, doc_vecs, offsets):
+        # Late-interaction MaxSim for every page in a single matrix product:
+        # sim[q, t] = <query token q, doc token t>, then a segmented max over
+        # each page's token range and a sum over query tokens.
+        n_pages = len(offsets) - 1
+        scores = np.zeros(n_pages, dtype=np.float32)
+        if n_pages == 0 or doc_vecs.shape[0] == 0:
+            return scores
+
+        query = np.asarray(data, dtype=np.float32)
+        sim = query @ doc_vecs.T
+        # 没有向量的页面得分为 0，reduceat 只能作用于非空区间
+        non_empty = offsets[1:] > offsets[:-1]
+        page_max = np.maximum.reduceat(sim, offsets[:-1][non_empty], axis=1)
+        scores[non_empty] = page_max.sum(axis=0)
+        return scores
 
     def insert(self, data, collection_name):
         # Insert ColQwen embeddings and metadata for a document into the collection.
-        colqwen_vecs = [vec for vec in data["colqwen_vecs"]]
+        # Milvus FLOAT_VECTOR 需要 float32，二进制响应可能是 float16
+        colqwen_vecs = np.asarray(data["colqwen_vecs"], dtype=np.float32)
         seq_length = len(colqwen_vecs)
 
         # Insert the data as multiple vectors (one for each sequence) along with the corresponding metadata.
@@ -163,5 +306,48 @@ class MilvusManager:
             ],
         )
 
+    def insert_bulk(
+        self,
+        collection_name,
+        vectors,
+        page_offsets,
+        image_ids,
+        page_numbers,
+        file_id,
+        batch_size=None,
+    ):
+        # Insert the embeddings of a whole file in column-oriented batches.
+        # vectors is one contiguous (n_tokens, dim) matrix, page i owns rows
+        # page_offsets[i]:page_offsets[i + 1].
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        page_offsets = np.asarray(page_offsets, dtype=np.int64)
+        batch_size = batch_size or settings.milvus_insert_batch_size
+        counts = np.diff(page_offsets)
+        # 按 token 展开每一行的元数据列
+        row_image_ids = np.repeat(np.asarray(image_ids, dtype=object), counts)
+        row_page_numbers = np.repeat(np.asarray(page_numbers, dtype=np.int64), counts)
+
+        collection = self._get_orm_collection(collection_name)
+        total = int(page_offsets[-1]) if len(page_offsets) else 0
+        for start in range(0, total, batch_size):
+            end = min(start + batch_size, total)
+            # 列顺序与 schema 一致（pk 为 auto_id，不需要提供）
+            collection.insert(
+                [
+                    vectors[start:end],
+                    row_image_ids[start:end].tolist(),
+                    row_page_numbers[start:end].tolist(),
+                    [file_id] * (end - start),
+                ]
+            )
+        return total
+
+    def _get_orm_collection(self, collection_name):
+        # MilvusClient only accepts row dicts, column inserts go through the ORM.
+        if not self._orm_connected:
+            connections.connect(alias=MILVUS_ORM_ALIAS, uri=settings.milvus_uri)
+            self._orm_connected = True
+        return Collection(collection_name, using=MILVUS_ORM_ALIAS)
+
 
 milvus_client = MilvusManager()
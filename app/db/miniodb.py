@@ -1,6 +1,12 @@
+import asyncio
 import base64
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from aiobotocore.config import AioConfig
+import botocore.session
 from botocore.exceptions import ClientError
-from typing import List
+from typing import Dict, List
 import aioboto3
 from io import BytesIO
 from fastapi import UploadFile
@@ -15,6 +21,11 @@ class AsyncMinIOManager:
         self.minio_url = settings.minio_url
         self.access_key = settings.minio_access_key
         self.secret_key = settings.minio_secret_key
+        self._client = None  # 应用生命周期内共享的 S3 客户端
+        self._exit_stack = None
+        self._client_lock = None
+        self._signer = None  # 本地签名客户端
+        self._presigned_urls = OrderedDict()  # (file_name, expires) -> (url, 失效时间)
 
     async def init_minio(self):
         """在应用启动时调用，用于检查并创建桶"""
@@ -23,134 +34,222 @@ class AsyncMinIOManager:
         except Exception as e:
             logger.error(f"Error initializing MinIO: {e}")
 
+    async def get_client(self):
+        """获取共享的 S3 客户端（懒加载，连接池在所有方法间复用）"""
+        if self._client is not None:
+            return self._client
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
+        async with self._client_lock:
+            if self._client is None:
+                exit_stack = AsyncExitStack()
+                self._client = await exit_stack.enter_async_context(
+                    self.session.client(
+                        "s3",
+                        endpoint_url=self.minio_url,
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        use_ssl=False,
+                        config=AioConfig(
+                            max_pool_connections=settings.minio_max_pool_connections,
+                            tcp_keepalive=True,
+                            retries={
+                                "max_attempts": settings.minio_max_retries,
+                                "mode": "standard",
+                            },
+                        ),
+                    )
+                )
+                self._exit_stack = exit_stack
+        return self._client
+
+    async def close(self):
+        """在应用关闭时调用，释放共享的 S3 客户端"""
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+        self._client = None
+        self._exit_stack = None
+
     async def create_bucket(self):
         """检查并创建桶"""
-        async with self.session.client(
-            "s3",
-            endpoint_url=self.minio_url,
-            aws_access_key_id=self.access_key,
-            aws_secret_access_key=self.secret_key,
-            use_ssl=False,
-        ) as client:
-            # 检查桶是否存在
-            try:
-                buckets = await client.list_buckets()
-                if self.bucket_name not in [
-                    bucket["Name"] for bucket in buckets["Buckets"]
-                ]:
-                    await client.create_bucket(Bucket=self.bucket_name)
-                    logger.info(f"Bucket '{self.bucket_name}' created.")
-                else:
-                    logger.info(f"Bucket '{self.bucket_name}' already exists.")
-            except Exception as e:
-                logger.error(f"Error checking or creating bucket: {e}")
-                raise e
-
-    async def upload_image(self, file_name: str, image_stream: BytesIO):
+        client = await self.get_client()
+        # 检查桶是否存在
+        try:
+            buckets = await client.list_buckets()
+            if self.bucket_name not in [
+                bucket["Name"] for bucket in buckets["Buckets"]
+            ]:
+                await client.create_bucket(Bucket=self.bucket_name)
+                logger.info(f"Bucket '{self.bucket_name}' created.")
+            else:
+                logger.info(f"Bucket '{self.bucket_name}' already exists.")
+        except Exception as e:
+            logger.error(f"Error checking or creating bucket: {e}")
+            raise e
+
+    async def upload_image(
+        self, file_name: str, image_stream: BytesIO, content_type: str = "image/png"
+    ):
         """将图像流上传到 MinIO"""
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                # 将图像上传为对象
-                image_stream.seek(0)  # 将指针重置到流的开始位置
+        client = await self.get_client()
+        try:
+            # 将图像上传为对象
+            image_stream.seek(0)  # 将指针重置到流的开始位置
+            await client.put_object(
+                Bucket=self.bucket_name,
+                Key=file_name,
+                Body=image_stream,
+                ContentType=content_type,
+            )
+        except Exception as e:
+            logger.exception(f"MinIO error upload_image: {e}")
+            raise e
+
+    async def upload_file(self, file_name: str, upload_file: UploadFile):
+        """将文件流上传到 MinIO（大文件分片流式上传，不整体读入内存）"""
+        part_size = settings.minio_multipart_chunk_size
+        client = await self.get_client()
+        upload_id = None
+        try:
+            chunk = await upload_file.read(part_size)
+            if len(chunk) < part_size:
+                # 小文件直接上传
                 await client.put_object(
                     Bucket=self.bucket_name,
                     Key=file_name,
-                    Body=image_stream,
-                    ContentType="image/png",
+                    Body=chunk,
+                    ContentType=upload_file.content_type,
                 )
-            except Exception as e:
-                logger.exception(f"MinIO error upload_image: {e}")
-                raise e
+                return
 
-    async def upload_file(self, file_name: str, upload_file: UploadFile):
-        """将文件流上传到 MinIO"""
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                # 读取文件内容（适配大文件分块读取）
-                file_data = await upload_file.read()
-
-                # 将文件上传为对象
-                await client.put_object(
+            response = await client.create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=file_name,
+                ContentType=upload_file.content_type,
+            )
+            upload_id = response["UploadId"]
+            parts = []
+            part_number = 1
+            while chunk:
+                part = await client.upload_part(
                     Bucket=self.bucket_name,
                     Key=file_name,
-                    Body=file_data,
-                    ContentType=upload_file.content_type,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=chunk,
+                )
+                parts.append({"ETag": part["ETag"], "PartNumber": part_number})
+                part_number += 1
+                chunk = await upload_file.read(part_size)
+            await client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=file_name,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception as e:
+            logger.exception(f"MinIO error upload_file: {e}")
+            if upload_id is not None:
+                await client.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=file_name, UploadId=upload_id
                 )
-            except Exception as e:
-                logger.exception(f"MinIO error upload_file: {e}")
-                raise e
+            raise e
 
     async def download_image_and_convert_to_base64(self, file_name: str):
         """下载图像并转换为Base64编码"""
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                response = await client.get_object(
-                    Bucket=self.bucket_name, Key=file_name
-                )
-                image_data = await response["Body"].read()  # 读取图像数据
-                base64_image = base64.b64encode(image_data).decode("utf-8")
-                return base64_image
-            except Exception as e:
-                logger.exception(f"Error downloading image: {e}")
-                raise e
+        client = await self.get_client()
+        try:
+            response = await client.get_object(
+                Bucket=self.bucket_name, Key=file_name
+            )
+            image_data = await response["Body"].read()  # 读取图像数据
+            base64_image = base64.b64encode(image_data).decode("utf-8")
+            return base64_image
+        except Exception as e:
+            logger.exception(f"Error downloading image: {e}")
+            raise e
+
+    async def download_image_as_data_url(
+        self, file_name: str, content_type: str = "image/png"
+    ) -> str:
+        """下载图像并编码为 data URL"""
+        client = await self.get_client()
+        try:
+            response = await client.get_object(Bucket=self.bucket_name, Key=file_name)
+            image_data = await response["Body"].read()  # 读取图像数据
+            prefix = f"data:{content_type};base64,".encode("ascii")
+            return (prefix + base64.b64encode(image_data)).decode("ascii")
+        except Exception as e:
+            logger.exception(f"Error downloading image: {e}")
+            raise e
+
+    def _get_signer(self):
+        """本地签名用的同步 botocore 客户端（只做签名计算，不发起网络请求）"""
+        if self._signer is None:
+            self._signer = botocore.session.get_session().create_client(
+                "s3",
+                endpoint_url=self.minio_url,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                use_ssl=False,
+            )
+        return self._signer
+
+    def _sign_url(self, file_name: str, expires: int) -> str:
+        key = (file_name, expires)
+        now = time.monotonic()
+        cached = self._presigned_urls.get(key)
+        if cached is not None and cached[1] > now:
+            self._presigned_urls.move_to_end(key)
+            return cached[0]
+
+        url = self._get_signer().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket_name, "Key": file_name},
+            ExpiresIn=expires,
+        )
+        # 在 URL 过期前留出余量（有效期的 10%，最多 1 小时）使缓存失效
+        valid_for = expires - min(expires * 0.1, 3600)
+        self._presigned_urls[key] = (url, now + valid_for)
+        self._presigned_urls.move_to_end(key)
+        while len(self._presigned_urls) > settings.minio_presigned_url_cache_size:
+            self._presigned_urls.popitem(last=False)
+        return url
 
     async def create_presigned_url(self, file_name: str, expires: int = 3153600000):
-        """生成预签名 URL 以供文件下载"""
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                url = await client.generate_presigned_url(
-                    "get_object",
-                    Params={"Bucket": self.bucket_name, "Key": file_name},
-                    ExpiresIn=expires,
-                )
-                logger.info(f"Generated presigned URL: {url}")
-                return url
-            except Exception as e:
-                logger.exception(f"Error generating presigned URL: {e}")
-                raise e
+        """生成预签名 URL 以供文件下载（本地签名，按对象缓存）"""
+        try:
+            url = self._sign_url(file_name, expires)
+            logger.info(f"Generated presigned URL: {url}")
+            return url
+        except Exception as e:
+            logger.exception(f"Error generating presigned URL: {e}")
+            raise e
+
+    async def create_presigned_urls(
+        self, file_names: List[str], expires: int = 3153600000
+    ) -> Dict[str, str]:
+        """批量生成预签名 URL，返回 {file_name: url}"""
+        try:
+            return {
+                file_name: self._sign_url(file_name, expires) for file_name in file_names
+            }
+        except Exception as e:
+            logger.exception(f"Error generating presigned URLs: {e}")
+            raise e
 
     async def get_file_from_minio(self, minio_filename):
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                response = await client.get_object(
-                    Bucket=self.bucket_name, Key=minio_filename
-                )
-                file_data = await response["Body"].read()  # 读取图像数据
-                logger.info(f"Get minio object: {minio_filename}")
-                return file_data
-            except Exception as e:
-                logger.exception(f"Error getting minio object: {e}")
-                raise e
+        client = await self.get_client()
+        try:
+            response = await client.get_object(
+                Bucket=self.bucket_name, Key=minio_filename
+            )
+            file_data = await response["Body"].read()  # 读取图像数据
+            logger.info(f"Get minio object: {minio_filename}")
+            return file_data
+        except Exception as e:
+            logger.exception(f"Error getting minio object: {e}")
+            raise e
 
     # 批量删除
     async def bulk_delete(self, keys: List[str]):
@@ -159,48 +258,37 @@ class AsyncMinIOManager:
         if not unique_keys:
             return
 
-        async with self.session.client(
-            "s3",
-            endpoint_url=settings.minio_url,
-            aws_access_key_id=settings.minio_access_key,
-            aws_secret_access_key=settings.minio_secret_key,
-            use_ssl=False,
-        ) as client:
-            try:
-                # 每 1000 个对象为一组进行删除
-                for i in range(0, len(unique_keys), 1000):
-                    chunk = unique_keys[i : i + 1000]
-                    response = await client.delete_objects(
-                        Bucket=self.bucket_name,
-                        Delete={"Objects": [{"Key": k} for k in chunk]},
-                    )
-                    # 记录删除失败的对象
-                    if errors := response.get("Errors", []):
-                        for err in errors:
-                            logger.error(
-                                f"MinIO删除失败 | Key: {err['Key']} "
-                                f"| Code: {err['Code']} | Message: {err['Message']}"
-                            )
-                            raise
-
-            except Exception as e:
-                logger.exception(f"MinIO 批量删除异常: {str(e)}")
-                raise
+        client = await self.get_client()
+        try:
+            # 每 1000 个对象为一组进行删除
+            for i in range(0, len(unique_keys), 1000):
+                chunk = unique_keys[i : i + 1000]
+                response = await client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={"Objects": [{"Key": k} for k in chunk]},
+                )
+                # 记录删除失败的对象
+                if errors := response.get("Errors", []):
+                    for err in errors:
+                        logger.error(
+                            f"MinIO删除失败 | Key: {err['Key']} "
+                            f"| Code: {err['Code']} | Message: {err['Message']}"
+                        )
+                        raise
+
+        except Exception as e:
+            logger.exception(f"MinIO 批量删除异常: {str(e)}")
+            raise
 
     async def validate_file_existence(self, filename: str) -> bool:
         try:
-            async with self.session.client(
-                "s3",
-                endpoint_url=settings.minio_url,
-                aws_access_key_id=settings.minio_access_key,
-                aws_secret_access_key=settings.minio_secret_key,
-                use_ssl=False,
-            ) as client:
-                await client.head_object(Bucket=self.bucket_name, Key=filename)
-                return True
+            client = await self.get_client()
+            await client.head_object(Bucket=self.bucket_name, Key=filename)
+            return True
         except ClientError as e:
             if e.response["Error"]["Code"] == "404":
                 return False
             raise
 
+
 async_minio_manager = AsyncMinIOManager()
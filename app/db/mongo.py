@@ -687,6 +687,35 @@ class MongoDB:
         )
         return {"status": "success" if result.modified_count > 0 else "failed"}
 
+    async def knowledge_base_add_files(
+        self, knowledge_base_id: str, files: List[Dict[str, str]]
+    ) -> Dict[str, Any]:
+        """向指定知识库中批量添加文件，files 中每项包含 file_id/original_filename/minio_filename/minio_url"""
+        if not files:
+            return {"status": "success"}
+        now = beijing_time_now()
+        result = await self.db.knowledge_bases.update_one(
+            {"knowledge_base_id": knowledge_base_id},
+            {
+                "$push": {
+                    "files": {
+                        "$each": [
+                            {
+                                "file_id": file["file_id"],
+                                "filename": file["original_filename"],
+                                "minio_filename": file["minio_filename"],
+                                "minio_url": file["minio_url"],
+                                "created_at": now,
+                            }
+                            for file in files
+                        ]
+                    },
+                },
+                "$set": {"last_modify_at": now},
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
     async def get_files_by_knowledge_base_id(
         self, knowledge_base_id: str
     ) -> List[Dict[str, str]]:
@@ -747,6 +776,34 @@ class MongoDB:
             logger.warning(f"文件ID冲突: {file_id}")
             return {"status": "failed", "message": "文件ID已存在，请勿重复上传"}
 
+    async def create_files_bulk(self, files: List[Dict[str, str]]):
+        """批量创建文件记录，files 中每项包含 create_files 的所有参数"""
+        if not files:
+            return {"status": "success"}
+        now = beijing_time_now()
+        documents = [
+            {
+                "file_id": file["file_id"],
+                "filename": file["filename"],
+                "username": file["username"],
+                "minio_filename": file["minio_filename"],
+                "minio_url": file["minio_url"],
+                "knowledge_db_id": file["knowledge_db_id"],
+                "images": [],
+                "created_at": now,
+                "last_modify_at": now,
+                "is_delete": False,
+            }
+            for file in files
+        ]
+
+        try:
+            await self.db.files.insert_many(documents, ordered=False)
+            return {"status": "success"}
+        except BulkWriteError as e:
+            logger.warning(f"批量创建文件记录部分失败: {e.details.get('writeErrors')}")
+            return {"status": "failed", "message": "部分文件ID已存在，请勿重复上传"}
+
     async def add_images(
         self,
         file_id: str,
@@ -754,6 +811,8 @@ class MongoDB:
         minio_filename: str,
         minio_url: str,
         page_number: str,
+        preview_minio_filename: Optional[str] = None,
+        preview_minio_url: Optional[str] = None,
     ) -> Dict[str, Any]:
         """向指定的 file_id 中添加解析的图片"""
         images = {
@@ -762,6 +821,9 @@ class MongoDB:
             "minio_url": minio_url,
             "page_number": page_number,
         }
+        if preview_minio_filename:
+            images["preview_minio_filename"] = preview_minio_filename
+            images["preview_minio_url"] = preview_minio_url
         result = await self.db.files.update_one(
             {"file_id": file_id, "is_delete": False},
             {
@@ -773,6 +835,33 @@ class MongoDB:
         )
         return {"status": "success" if result.modified_count > 0 else "failed"}
 
+    async def add_images_bulk(
+        self, file_id: str, images: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """一次性向指定的 file_id 中添加多张解析的图片"""
+        if not images:
+            return {"status": "success"}
+        result = await self.db.files.update_one(
+            {"file_id": file_id, "is_delete": False},
+            {
+                "$push": {
+                    "images": {"$each": images},
+                },
+                "$set": {"last_modify_at": beijing_time_now()},
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
+    async def clear_file_images(self, file_id: str) -> Dict[str, Any]:
+        """清空指定 file_id 已解析的图片记录（文件处理失败时清理部分结果）"""
+        result = await self.db.files.update_one(
+            {"file_id": file_id},
+            {
+                "$set": {"images": [], "last_modify_at": beijing_time_now()},
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
     async def get_file_and_image_info(
         self, file_id: str, image_id: str
     ) -> Dict[str, Any]:
@@ -816,6 +905,8 @@ class MongoDB:
         image_info = images[0]  # 因为使用了 $ 操作符，数组只有一个匹配元素
         image_minio_filename = image_info.get("minio_filename")
         image_minio_url = image_info.get("minio_url")  # 新增图片的 minio_url
+        # 预览图（可选），没有时使用原图
+        image_preview_url = image_info.get("preview_minio_url") or image_minio_url
 
         # 返回所有字段
         return {
@@ -826,6 +917,7 @@ class MongoDB:
             "file_minio_url": file_minio_url,  # 文件的 URL
             "image_minio_filename": image_minio_filename,
             "image_minio_url": image_minio_url,  # 图片的 URL
+            "image_preview_url": image_preview_url,  # 预览图的 URL
         }
 
     async def delete_files_base(self, file_id: str) -> dict:
@@ -866,6 +958,12 @@ class MongoDB:
                 for img in file.get("images", [])
                 if img.get("minio_filename")
             )
+            # 预览图文件
+            minio_files.extend(
+                img["preview_minio_filename"]
+                for img in file.get("images", [])
+                if img.get("preview_minio_filename")
+            )
 
         # 执行 MinIO 批量删除
         error_messages = []
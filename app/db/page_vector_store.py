@@ -0,0 +1,122 @@
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from app.core.config import settings
+from app.core.logging import logger
+
+
+class PageVectorStore:
+    """
+    本地页面多向量存储（重排用）
+    - 每个 image_id 的 token 向量以 float16 .npy 文件保存在磁盘上
+    - 目录结构: {root}/{collection_name}/{file_id}/{image_id}.npy
+    - 内存中保留一个按字节数淘汰的热点页面 LRU
+      （缓存读入内存的数组而不是内存映射，避免每个缓存页面占用一个文件描述符）
+    """
+
+    def __init__(self, root: str, cache_bytes: int, enabled: bool = True):
+        self.root = root
+        self.cache_bytes = cache_bytes
+        self.enabled = enabled
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_size = 0  # 缓存中数组的总字节数
+        self._lock = threading.Lock()
+
+    def _page_path(self, collection_name: str, file_id: str, image_id: str) -> str:
+        return os.path.join(self.root, collection_name, file_id, f"{image_id}.npy")
+
+    def put(self, collection_name: str, file_id: str, image_id: str, vectors):
+        """写入单个页面的 token 向量（原子替换）"""
+        if not self.enabled:
+            return
+        path = self._page_path(collection_name, file_id, image_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(vectors, dtype=np.float16))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # 本地缓存写入失败不影响主流程，重排时会回退到 Milvus
+            logger.warning(f"PageVectorStore write failed | {path} | {e}")
+
+    def get(
+        self, collection_name: str, file_id: str, image_id: str
+    ) -> Optional[np.ndarray]:
+        """读取单个页面的 token 向量，未命中返回 None"""
+        if not self.enabled or not file_id:
+            return None
+        key = f"{collection_name}/{image_id}"
+        with self._lock:
+            vectors = self._cache.get(key)
+            if vectors is not None:
+                self._cache.move_to_end(key)
+                return vectors
+
+        path = self._page_path(collection_name, file_id, image_id)
+        try:
+            vectors = np.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"PageVectorStore read failed | {path} | {e}")
+            return None
+
+        vectors.setflags(write=False)  # 缓存的数组在多个请求间共享，只读
+        if vectors.nbytes > self.cache_bytes:
+            return vectors
+        with self._lock:
+            if key in self._cache:
+                self._cache_size -= self._cache.pop(key).nbytes
+            self._cache[key] = vectors
+            self._cache_size += vectors.nbytes
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= evicted.nbytes
+        return vectors
+
+    def get_many(
+        self, collection_name: str, pages: List[Dict[str, str]]
+    ) -> Dict[str, np.ndarray]:
+        """批量读取，pages 中每项需包含 image_id 和 file_id，只返回命中的页面"""
+        found = {}
+        for page in pages:
+            vectors = self.get(collection_name, page["file_id"], page["image_id"])
+            if vectors is not None:
+                found[page["image_id"]] = vectors
+        return found
+
+    def _evict_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._cache if k.startswith(prefix)]:
+                self._cache_size -= self._cache.pop(key).nbytes
+
+    def delete_files(self, collection_name: str, file_ids: List[str]):
+        """删除指定文件的所有页面向量"""
+        if not self.enabled:
+            return
+        for file_id in file_ids:
+            shutil.rmtree(
+                os.path.join(self.root, collection_name, file_id), ignore_errors=True
+            )
+        # image_id 无法从 file_id 反查，直接清掉该集合的内存缓存
+        self._evict_prefix(f"{collection_name}/")
+
+    def delete_collection(self, collection_name: str):
+        """删除整个集合的页面向量"""
+        if not self.enabled:
+            return
+        shutil.rmtree(os.path.join(self.root, collection_name), ignore_errors=True)
+        self._evict_prefix(f"{collection_name}/")
+
+
+page_vector_store = PageVectorStore(
+    root=settings.page_vector_store_dir,
+    cache_bytes=settings.page_vector_cache_bytes,
+    enabled=settings.page_vector_store_enabled,
+)
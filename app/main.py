@@ -15,6 +15,8 @@ from app.db.redis import redis
 from app.db.miniodb import async_minio_manager
 from app.utils.kafka_producer import kafka_producer_manager
 from app.utils.kafka_consumer import kafka_consumer_manager
+from app.rag.get_embedding import model_server_client
+from app.rag.llm_client import llm_client_pool
 
 # 创建 FastAPIFramework 实例
 framework = FastAPIFramework(debug_mode=settings.debug_mode)
@@ -43,15 +45,21 @@ async def lifespan(app: FastAPI):
     await mongodb.connect()  # 连接 MongoDB
     await kafka_producer_manager.start()  # 启动Kafka生产者
     await async_minio_manager.init_minio()
+    await model_server_client.start()  # 启动 model_server 连接池
     # await kafka_consumer_manager.start()  # 启动Kafka消费者
-    asyncio.create_task(kafka_consumer_manager.consume_messages())  # 启动Kafka消费者
+    if settings.api_consume_tasks:
+        asyncio.create_task(kafka_consumer_manager.consume_messages())  # 启动Kafka消费者
 
     yield
     # 关闭事件处理代码可以放在这里
+    if settings.api_consume_tasks:
+        await kafka_consumer_manager.stop()  # 停止Kafka消费者（等待处理中的消息完成）
     await kafka_producer_manager.stop()  # 停止Kafka生产者
-    # await kafka_consumer_manager.stop()  # 停止Kafka消费者
+    await model_server_client.close()  # 关闭 model_server 连接池
+    await llm_client_pool.close()  # 关闭 LLM 客户端连接池
     await mysql.close()  # 关闭 MySQL 连接
     await mongodb.close()  # 关闭 MongoDB 连接
+    await async_minio_manager.close()  # 关闭 MinIO 客户端
     await redis.close()  # 关闭 Redis 连接
     logger.info("FastAPI Closed")
 
@@ -1,17 +1,26 @@
 # app/core/colbert_service.py
 from colpali_engine.models import ColQwen2_5, ColQwen2_5_Processor
-from colpali_engine.utils.torch_utils import ListDataset, get_torch_device
-from torch.utils.data import DataLoader
+from colpali_engine.utils.torch_utils import get_torch_device
 import torch
 from typing import List, cast
 from transformers.utils.import_utils import is_flash_attn_2_available
 from tqdm import tqdm
 from app.core.config import settings
+from app.core.logging import logger
 import numpy as np
 
 
 class ColBERTService:
-    def __init__(self, model_path):
+    def __init__(
+        self,
+        model_path,
+        max_batch_size: int = settings.colbert_max_batch_size,
+        max_batch_pixels: int = settings.colbert_max_batch_pixels,
+    ):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_pixels = max_batch_pixels
+        self.min_pixels = 56 * 56
+        self.max_pixels = 28 * 28 * 768
         self.device = torch.device(get_torch_device("auto"))
         self.model = ColQwen2_5.from_pretrained(
             model_path,
@@ -24,48 +33,92 @@ class ColBERTService:
         self.processor = cast(
             ColQwen2_5_Processor,
             ColQwen2_5_Processor.from_pretrained(
-                model_path, size={"shortest_edge": 56 * 56, "longest_edge": 28 * 28 * 768}
+                model_path,
+                size={
+                    "shortest_edge": self.min_pixels,
+                    "longest_edge": self.max_pixels,
+                },
             ),
         )
 
-    def process_query(self, queries: list) -> List[torch.Tensor]:
-        dataloader = DataLoader(
-            dataset=ListDataset[str](queries),
-            batch_size=1,
-            shuffle=False,
-            collate_fn=lambda x: self.processor.process_queries(x),
-        )
+    def process_query(self, queries: list) -> List[np.ndarray]:
+        batches = [
+            list(range(i, min(i + self.max_batch_size, len(queries))))
+            for i in range(0, len(queries), self.max_batch_size)
+        ]
+        qs = self._run_batches(queries, batches, self.processor.process_queries)
+        return [q.float().numpy() for q in qs]
+
+    def process_image(self, images: List) -> List[np.ndarray]:
+        # 按像素数排序后组批，尽量减少同一批次内的 padding
+        sizes = [self._image_pixels(image) for image in images]
+        order = sorted(range(len(images)), key=lambda i: sizes[i])
+        batches = []
+        batch, batch_pixels = [], 0
+        for i in order:
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_pixels + sizes[i] > self.max_batch_pixels
+            ):
+                batches.append(batch)
+                batch, batch_pixels = [], 0
+            batch.append(i)
+            batch_pixels += sizes[i]
+        if batch:
+            batches.append(batch)
+
+        ds = self._run_batches(images, batches, self.processor.process_images)
+        return [d.float().numpy() for d in ds]
+
+    def _image_pixels(self, image) -> int:
+        # 处理器会把图片缩放到 [min_pixels, max_pixels] 区间内
+        width, height = image.size
+        return min(max(width * height, self.min_pixels), self.max_pixels)
 
-        qs: List[torch.Tensor] = []
-        for batch_query in dataloader:
+    def _run_batches(self, items: List, batches: List[List[int]], collate_fn):
+        # 返回与 items 顺序一致的 embedding 列表
+        outputs: List[torch.Tensor] = [None] * len(items)
+        for batch in tqdm(batches, disable=len(batches) <= 1):
+            for i, embedding in zip(batch, self._forward(items, batch, collate_fn)):
+                outputs[i] = embedding
+        return outputs
+
+    def _forward(self, items: List, batch: List[int], collate_fn):
+        try:
             with torch.no_grad():
-                batch_query = {
-                    k: v.to(self.model.device) for k, v in batch_query.items()
+                batch_inputs = collate_fn([items[i] for i in batch])
+                batch_inputs = {
+                    k: v.to(self.model.device) for k, v in batch_inputs.items()
                 }
-                embeddings_query = self.model(**batch_query)
-            qs.extend(list(torch.unbind(embeddings_query.to("cpu"))))
-        for i in range(len(qs)):
-            qs[i] = qs[i].float().tolist()
-        return qs
+                embeddings = self.model(**batch_inputs).to("cpu")
+                attention_mask = batch_inputs["attention_mask"].to("cpu").bool()
+            # 去掉批处理时补齐的 padding token
+            return [
+                embedding[mask]
+                for embedding, mask in zip(torch.unbind(embeddings), attention_mask)
+            ]
+        except RuntimeError as e:
+            if not _is_oom_error(e) or len(batch) == 1:
+                raise
+            # 显存/内存不足时拆成两半重试
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            middle = len(batch) // 2
+            logger.warning(
+                f"ColBERT batch of {len(batch)} ran out of memory, retrying with {middle}"
+            )
+            return self._forward(items, batch[:middle], collate_fn) + self._forward(
+                items, batch[middle:], collate_fn
+            )
 
-    def process_image(self, images: List) -> List[List[float]]:
-        batch_size = 1 # if len(images) > 2 else len(images)
-        dataloader = DataLoader(
-            dataset=ListDataset[str](images),
-            batch_size=batch_size,
-            shuffle=False,
-            collate_fn=lambda x: self.processor.process_images(x),
-        )
 
-        ds: List[torch.Tensor] = []
-        for batch_doc in tqdm(dataloader):
-            with torch.no_grad():
-                batch_doc = {k: v.to(self.model.device) for k, v in batch_doc.items()}
-                embeddings_doc = self.model(**batch_doc)
-            ds.extend(list(torch.unbind(embeddings_doc.to("cpu"))))
-        for i in range(len(ds)):
-            ds[i] = ds[i].float().tolist()
-        return ds
+def _is_oom_error(e: RuntimeError) -> bool:
+    message = str(e)
+    return (
+        isinstance(e, torch.cuda.OutOfMemoryError)
+        or "out of memory" in message
+        or "can't allocate memory" in message
+    )
 
 
 colbert = ColBERTService(settings.colbert_model_path)
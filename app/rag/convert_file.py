@@ -1,31 +1,107 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+import multiprocessing
 import os
+import tempfile
+from functools import partial
+from typing import AsyncGenerator, Awaitable, Callable, List, Optional, Tuple
 from fastapi import UploadFile
-from pdf2image import convert_from_bytes
+from app.core.config import settings
 from app.db.miniodb import async_minio_manager
+from app.rag.rasterize import IMAGE_FORMATS, get_page_count, render_pages
 from bson.objectid import ObjectId
 import time
 from app.core.logging import logger
 
-async def convert_file_to_images(file_content):
-    # Read the contents of the uploaded file
-    images = convert_from_bytes(file_content)
-    images_buffer = []
+_rasterize_executor = None
 
+
+def get_rasterize_executor() -> ProcessPoolExecutor:
+    """PDF 栅格化进程池（懒加载，使用 spawn 避免在事件循环进程中 fork）"""
+    global _rasterize_executor
+    if _rasterize_executor is None:
+        _rasterize_executor = ProcessPoolExecutor(
+            max_workers=settings.rasterize_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _rasterize_executor
+
+
+def page_image_format():
+    """当前页面图片编码格式，返回 (格式名, Content-Type, 扩展名)"""
+    image_format = settings.page_image_format.lower()
+    if image_format not in IMAGE_FORMATS:
+        image_format = "png"
+    _, content_type, extension = IMAGE_FORMATS[image_format]
+    return image_format, content_type, extension
+
+
+async def iter_file_images(
+    file_content, on_page_count: Optional[Callable[[int], Awaitable]] = None
+) -> AsyncGenerator[Tuple[int, BytesIO, Optional[BytesIO]], None]:
+    """
+    流式栅格化：按页码范围分块在进程池中渲染，逐页产出 (页序号, 图片缓冲区, 预览图缓冲区)
+    - 同时最多有 rasterize_workers 个分块在渲染，消费方不取数据时生产自动暂停
+    - 页序号从 0 开始，按页面顺序产出；未开启预览时预览图为 None
+    - 编码格式由 page_image_format 等配置决定
+    - on_page_count 在得到总页数后被调用一次
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_rasterize_executor()
+    image_format, _, _ = page_image_format()
+    render = partial(
+        render_pages,
+        image_format=image_format,
+        png_compress_level=settings.page_image_png_compress_level,
+        jpeg_quality=settings.page_image_jpeg_quality,
+        preview_max_edge=settings.page_image_preview_max_edge,
+        preview_quality=settings.page_image_preview_quality,
+    )
     time_start = time.time()
-    for i, image in enumerate(images):
-        buffer = BytesIO()
 
-        # 保存图像到内存缓冲区
-        image.save(buffer, format="PNG", optimize=True)
-    
-        # 重置指针位置（关键步骤，参考MinIO上传逻辑）
-        buffer.seek(0)
-        images_buffer.append(buffer)
-    spending_time = time.time() - time_start 
-    logger.info(f"convert file to {len(images)} images spend time {spending_time}s")
+    # 写入临时文件，避免把整个文件内容序列化给每个子进程
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(file_content)
+        page_count = await loop.run_in_executor(executor, get_page_count, pdf_path)
+        if on_page_count is not None:
+            await on_page_count(page_count)
+
+        chunk_size = max(1, settings.rasterize_pages_per_chunk)
+        ranges = deque(
+            (first, min(first + chunk_size - 1, page_count))
+            for first in range(1, page_count + 1, chunk_size)
+        )
+        pending = deque()
+        try:
+            while ranges or pending:
+                while ranges and len(pending) < settings.rasterize_workers:
+                    first, last = ranges.popleft()
+                    pending.append(
+                        (
+                            first,
+                            loop.run_in_executor(executor, render, pdf_path, first, last),
+                        )
+                    )
+                first, future = pending.popleft()
+                for offset, (page, preview) in enumerate(await future):
+                    yield (
+                        first - 1 + offset,
+                        BytesIO(page),
+                        BytesIO(preview) if preview is not None else None,
+                    )
+        finally:
+            for _, future in pending:
+                future.cancel()
+    finally:
+        os.remove(pdf_path)
+
+    spending_time = time.time() - time_start
+    logger.info(f"convert file to {page_count} images spend time {spending_time}s")
 
-    return images_buffer
 
 async def save_file_to_minio(username:str, uploadfile: UploadFile):
     # 将生成的图像上传到 MinIO
@@ -37,10 +113,22 @@ async def save_file_to_minio(username:str, uploadfile: UploadFile):
     # minio_url = minio_url.replace("localhost:9110", "127.0.0.1:9110")
     return file_name, minio_url
 
-async def save_image_to_minio(username, filename, image_stream):
+async def save_files_to_minio(username: str, uploadfiles: List[UploadFile]):
+    """并发上传多个文件（并发数受限），按输入顺序返回 (file_name, minio_url) 列表"""
+    semaphore = asyncio.Semaphore(settings.minio_file_upload_concurrency)
+
+    async def save(uploadfile: UploadFile):
+        async with semaphore:
+            return await save_file_to_minio(username, uploadfile)
+
+    return await asyncio.gather(*(save(uploadfile) for uploadfile in uploadfiles))
+
+async def save_image_to_minio(
+    username, filename, image_stream, extension=".png", content_type="image/png"
+):
     # 将生成的图像上传到 MinIO
-    file_name = f"{username}_{os.path.splitext(filename)[0]}_{ObjectId()}.png"
-    await async_minio_manager.upload_image(file_name, image_stream)
+    file_name = f"{username}_{os.path.splitext(filename)[0]}_{ObjectId()}{extension}"
+    await async_minio_manager.upload_image(file_name, image_stream, content_type)
     minio_url = await async_minio_manager.create_presigned_url(file_name)
 
     # minio_url = minio_url.replace("localhost:9110", "192.168.1.5:9110")
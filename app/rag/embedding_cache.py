@@ -0,0 +1,113 @@
+import hashlib
+import time
+import unicodedata
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from app.core.config import settings
+from app.core.logging import logger
+from app.db.redis import redis
+from app.rag.get_embedding import get_embeddings_from_httpx
+
+
+class QueryEmbeddingCache:
+    """
+    查询 embedding 两级缓存
+    - 一级：进程内 LRU（带 TTL）
+    - 二级：Redis，以 float16 .npy 二进制格式存储
+    - key 由模型路径 + 规范化后的查询文本生成
+    """
+
+    def __init__(self, model_path: str, max_size: int, ttl: int, use_redis: bool):
+        self.model_path = model_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", query).split())
+
+    def make_key(self, query: str) -> str:
+        """query 需已经过 normalize"""
+        digest = hashlib.sha256(
+            f"{self.model_path}\0{query}".encode("utf-8")
+        ).hexdigest()
+        return f"query_embedding:{digest}"
+
+    def _get_local(self, key: str):
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return embedding
+
+    def _set_local(self, key: str, embedding: np.ndarray):
+        self._local[key] = (time.monotonic() + self.ttl, embedding)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def _get_redis(self, key: str):
+        try:
+            redis_connection = await redis.get_embedding_cache_connection()
+            data = await redis_connection.get(key)
+        except Exception as e:
+            logger.warning(f"Query embedding cache redis get failed: {e}")
+            return None
+        if data is None:
+            return None
+        # 兼容旧版本写入的 float16 数据，查询向量统一为 float32
+        return np.load(BytesIO(data)).astype(np.float32, copy=False)
+
+    async def _set_redis(self, key: str, embedding: np.ndarray):
+        buffer = BytesIO()
+        np.save(buffer, embedding)
+        try:
+            redis_connection = await redis.get_embedding_cache_connection()
+            await redis_connection.set(key, buffer.getvalue(), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"Query embedding cache redis set failed: {e}")
+
+    async def get_query_embedding(self, query: str) -> np.ndarray:
+        """获取单条查询的 embedding，未命中时调用 model_server"""
+        # 缓存键和实际做 embedding 的文本保持一致
+        query = self.normalize(query)
+        key = self.make_key(query)
+
+        embedding = self._get_local(key)
+        if embedding is not None:
+            self.stats["local_hits"] += 1
+            return embedding
+
+        if self.use_redis:
+            embedding = await self._get_redis(key)
+            if embedding is not None:
+                self.stats["redis_hits"] += 1
+                self._set_local(key, embedding)
+                return embedding
+
+        self.stats["misses"] += 1
+        embedding = (await get_embeddings_from_httpx([query], endpoint="embed_text"))[0]
+        # 各级缓存和 Milvus 检索统一使用 float32（model_server 可能返回 float16）
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._set_local(key, embedding)
+        if self.use_redis:
+            await self._set_redis(key, embedding)
+        logger.info(f"Query embedding cache miss, stats: {self.stats}")
+        return embedding
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    model_path=settings.colbert_model_path,
+    max_size=settings.query_embedding_cache_size,
+    ttl=settings.query_embedding_cache_ttl,
+    use_redis=settings.query_embedding_cache_redis,
+)
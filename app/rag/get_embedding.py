@@ -1,36 +1,154 @@
+import itertools
 import json
+import time
 import httpx
 import numpy as np
-from typing import Literal
+from typing import List, Literal
 
 from tenacity import retry, stop_after_attempt, wait_exponential
+from app.core.config import settings
+from app.core.logging import logger
+
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def decode_embeddings(response: httpx.Response) -> List[np.ndarray]:
+    """解析 model_server 返回的 embedding（二进制或 JSON）"""
+    if response.headers.get("content-type", "").startswith(BINARY_MEDIA_TYPE):
+        dtype = np.dtype(response.headers["x-embedding-dtype"])
+        dim = int(response.headers["x-embedding-dim"])
+        lengths = [
+            int(length)
+            for length in response.headers.get("x-embedding-lengths", "").split(",")
+            if length
+        ]
+        if not lengths:
+            return []
+        # 零拷贝：所有页面共享同一块缓冲区，按 token 数切分成视图
+        flat = np.frombuffer(response.content, dtype=dtype).reshape(-1, dim)
+        return np.split(flat, np.cumsum(lengths)[:-1])
+    return [np.array(embedding) for embedding in response.json()["embeddings"]]
+
+
+class ModelServerEndpoint:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0  # 正在处理的请求数
+        self.failures = 0  # 连续失败次数
+        self.unhealthy_until = 0.0  # 熔断截止时间
+
+    def is_healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+
+class ModelServerClient:
+    """
+    model_server 的长连接 HTTP 客户端
+    - 应用生命周期内复用同一个 httpx.AsyncClient（连接池 + keep-alive）
+    - 多个 model_server 副本之间做负载均衡（round_robin / least_outstanding）
+    - 按端点记录连续失败次数，超过阈值后在冷却期内不再选择该端点
+    """
+
+    def __init__(self):
+        self.endpoints = [ModelServerEndpoint(url) for url in settings.model_server_urls]
+        self.policy = settings.model_server_lb_policy
+        self.client: httpx.AsyncClient = None
+        self._counter = itertools.count()
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=settings.model_server_http2,  # 需要安装 httpx[http2]
+                limits=httpx.Limits(
+                    max_connections=settings.model_server_max_connections,
+                    max_keepalive_connections=settings.model_server_max_keepalive,
+                ),
+                timeout=settings.model_server_timeout,
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _pick_endpoint(self) -> ModelServerEndpoint:
+        now = time.monotonic()
+        # 全部熔断时退化为在所有端点中选择
+        candidates = [e for e in self.endpoints if e.is_healthy(now)] or self.endpoints
+        offset = next(self._counter)
+        if self.policy == "least_outstanding":
+            # 并列时轮询，避免总是选中第一个端点
+            rotated = candidates[offset % len(candidates) :] + candidates[
+                : offset % len(candidates)
+            ]
+            return min(rotated, key=lambda e: e.outstanding)
+        return candidates[offset % len(candidates)]
+
+    def _record_failure(self, endpoint: ModelServerEndpoint):
+        endpoint.failures += 1
+        if endpoint.failures >= settings.model_server_max_failures:
+            endpoint.unhealthy_until = (
+                time.monotonic() + settings.model_server_unhealthy_cooldown
+            )
+            logger.warning(
+                f"Model server {endpoint.url} marked unhealthy after "
+                f"{endpoint.failures} failures"
+            )
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        await self.start()
+        endpoint = self._pick_endpoint()
+        endpoint.outstanding += 1
+        try:
+            response = await self.client.post(f"{endpoint.url}/{path}", **kwargs)
+        except httpx.TransportError:
+            self._record_failure(endpoint)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        if response.status_code >= 500:
+            self._record_failure(endpoint)
+        else:
+            endpoint.failures = 0
+            endpoint.unhealthy_until = 0.0
+        return response
+
+
+model_server_client = ModelServerClient()
+
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10)
 )
 async def get_embeddings_from_httpx(
-    data: list, 
+    data: list,
     endpoint: Literal["embed_text", "embed_image"]  # 限制端点类型
 ):
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            if "text" in endpoint:
-                response = await client.post(
-                    f"http://localhost:8005/{endpoint}",
-                    json={"queries": data}, 
-                    timeout=120.0  # 根据文件大小调整超时
-                )
-            else:
-                response = await client.post(
-                    f"http://localhost:8005/{endpoint}",
-                    #json={payload_key: data}  # 动态字段名
-                    files=data,
-                    timeout=120.0  # 根据文件大小调整超时
-                )
-            response.raise_for_status()
-            return np.array(response.json()["embeddings"])
-        except httpx.HTTPStatusError as e:
-            raise Exception(f"HTTP request failed: {e}")
-        except json.JSONDecodeError as e:
-            raise Exception(f"HTTP request failed: {e}")
\ No newline at end of file
+    headers = {}
+    if settings.embedding_binary_response:
+        headers = {
+            "Accept": f"{BINARY_MEDIA_TYPE}, application/json;q=0.9",
+            "X-Embedding-Dtype": settings.embedding_binary_dtype,
+        }
+
+    try:
+        if "text" in endpoint:
+            response = await model_server_client.post(
+                endpoint,
+                json={"queries": data},
+                headers=headers,
+            )
+        else:
+            response = await model_server_client.post(
+                endpoint,
+                #json={payload_key: data}  # 动态字段名
+                files=data,
+                headers=headers,
+            )
+        response.raise_for_status()
+        return decode_embeddings(response)
+    except httpx.HTTPStatusError as e:
+        raise Exception(f"HTTP request failed: {e}")
+    except json.JSONDecodeError as e:
+        raise Exception(f"HTTP request failed: {e}")
@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from app.core.config import settings
+from app.core.logging import logger
+
+
+class PageImageCache:
+    """
+    热点页面图片缓存（按 minio_filename 缓存已编码好的 data URL）
+    - 内存层：按字节数淘汰的 LRU
+    - 磁盘层（可选）：本地目录，按文件 mtime 淘汰的 LRU
+      目录本身就是索引（启动时和定期扫描得到总字节数），
+      多个进程共享同一目录时按整个目录的总字节数淘汰
+    - 记录各层命中次数，便于观察命中率
+    """
+
+    # 磁盘层重新扫描目录的间隔（秒），用于统计其他进程写入的文件
+    DISK_RESCAN_INTERVAL = 60
+    # 超出上限时淘汰到上限的这个比例，避免每次写入都触发淘汰
+    DISK_EVICT_TARGET = 0.9
+
+    def __init__(self, max_bytes: int, disk_dir: str, disk_max_bytes: int):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # 磁盘层总字节数的估计值，首次使用时扫描目录得到
+        self._disk_scanned_at = 0.0
+        self._disk_lock = threading.Lock()  # 磁盘层读写在线程池中执行
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _disk_path(self, file_name: str) -> str:
+        digest = hashlib.sha256(file_name.encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.txt")
+
+    def _put_memory(self, file_name: str, data_url: str):
+        size = len(data_url)
+        if size > self.max_bytes:
+            return
+        if file_name in self._memory:
+            self._memory_bytes -= len(self._memory.pop(file_name))
+        self._memory[file_name] = data_url
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_disk(self, file_name: str):
+        path = self._disk_path(file_name)
+        try:
+            with open(path, "r", encoding="ascii") as f:
+                data_url = f.read()
+            os.utime(path)  # 更新 mtime，作为 LRU 的访问时间
+        except OSError:
+            # 文件不存在或已被其他进程淘汰
+            return None
+        return data_url
+
+    def _scan_disk(self):
+        """扫描缓存目录，返回 [(mtime, 字节数, 路径)]"""
+        entries = []
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    try:
+                        stat = entry.stat()
+                        if entry.name.endswith(".tmp"):
+                            # 进程异常退出时遗留的临时文件
+                            if time.time() - stat.st_mtime > self.DISK_RESCAN_INTERVAL:
+                                os.remove(entry.path)
+                            continue
+                    except OSError:
+                        continue
+                    if entry.name.endswith(".txt"):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            pass
+        return entries
+
+    def _evict_disk(self):
+        """按 mtime 从旧到新删除文件，直到目录总字节数低于上限（需持有 _disk_lock）"""
+        entries = self._scan_disk()
+        total = sum(size for _, size, _ in entries)
+        if total > self.disk_max_bytes:
+            target = self.disk_max_bytes * self.DISK_EVICT_TARGET
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # 已被其他进程删除
+                total -= size
+        self._disk_bytes = total
+        self._disk_scanned_at = time.monotonic()
+
+    def _write_disk(self, file_name: str, data_url: str):
+        size = len(data_url)
+        if size > self.disk_max_bytes:
+            return
+        path = self._disk_path(file_name)
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="ascii") as f:
+                f.write(data_url)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"PageImageCache write failed | {path} | {e}")
+            return
+        with self._disk_lock:
+            if (
+                self._disk_bytes is None
+                or time.monotonic() - self._disk_scanned_at > self.DISK_RESCAN_INTERVAL
+            ):
+                self._evict_disk()
+            else:
+                self._disk_bytes += size
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk()
+
+    async def get_or_fetch(
+        self, file_name: str, fetch: Callable[[], Awaitable[str]]
+    ) -> str:
+        """命中缓存时直接返回 data URL，否则调用 fetch 获取并写入缓存"""
+        data_url = self._memory.get(file_name)
+        if data_url is not None:
+            self._memory.move_to_end(file_name)
+            self.stats["memory_hits"] += 1
+            return data_url
+
+        if self.disk_dir:
+            loop = asyncio.get_running_loop()
+            data_url = await loop.run_in_executor(None, self._read_disk, file_name)
+            if data_url is not None:
+                self.stats["disk_hits"] += 1
+                self._put_memory(file_name, data_url)
+                return data_url
+
+        self.stats["misses"] += 1
+        data_url = await fetch()
+        self._put_memory(file_name, data_url)
+        if self.disk_dir:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_disk, file_name, data_url)
+        return data_url
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+page_image_cache = PageImageCache(
+    max_bytes=settings.page_image_cache_bytes,
+    disk_dir=settings.page_image_cache_dir,
+    disk_max_bytes=settings.page_image_cache_disk_bytes,
+)
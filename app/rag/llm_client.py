@@ -0,0 +1,94 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.core.config import settings
+from app.core.logging import logger
+
+
+class _PooledClient:
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+        self.in_use = 0  # 正在使用该客户端的请求数
+        self.last_used = time.monotonic()
+
+
+class LLMClientPool:
+    """
+    按 (model_url, api_key) 复用的 AsyncOpenAI 客户端
+    - 每个端点一个客户端，底层 httpx 连接池在多轮对话之间复用（免去每轮的连接/TLS 建立）
+    - 空闲超过 llm_client_idle_timeout 的客户端会被关闭
+    - 客户端总数超过 llm_client_max_clients 时关闭最久未使用的空闲客户端
+    """
+
+    def __init__(self):
+        self._clients: "OrderedDict[tuple, _PooledClient]" = OrderedDict()
+        self._lock = None
+
+    def _create_client(self, model_url: str, api_key: str) -> AsyncOpenAI:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.llm_client_max_connections,
+                max_keepalive_connections=settings.llm_client_max_keepalive,
+                keepalive_expiry=settings.llm_client_idle_timeout,
+            ),
+            timeout=settings.llm_client_timeout,
+            follow_redirects=True,
+        )
+        return AsyncOpenAI(api_key=api_key, base_url=model_url, http_client=http_client)
+
+    def _pop_evictable(self) -> list:
+        """取出需要关闭的空闲客户端（只淘汰当前没有请求在使用的）"""
+        now = time.monotonic()
+        evicted = []
+        for key, pooled in list(self._clients.items()):
+            if pooled.in_use:
+                continue
+            if (
+                now - pooled.last_used > settings.llm_client_idle_timeout
+                or len(self._clients) > settings.llm_client_max_clients
+            ):
+                evicted.append(self._clients.pop(key))
+        return evicted
+
+    async def _close_clients(self, pooled_clients: list):
+        for pooled in pooled_clients:
+            try:
+                await pooled.client.close()
+            except Exception as e:
+                logger.warning(f"Close LLM client {pooled.client.base_url} failed: {e}")
+
+    @asynccontextmanager
+    async def acquire(self, model_url: str, api_key: str):
+        """获取 (model_url, api_key) 对应的客户端，使用期间不会被淘汰"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        key = (model_url, api_key)
+        async with self._lock:
+            pooled = self._clients.get(key)
+            if pooled is None:
+                pooled = _PooledClient(self._create_client(model_url, api_key))
+                self._clients[key] = pooled
+            self._clients.move_to_end(key)
+            pooled.in_use += 1
+            evicted = self._pop_evictable()
+        await self._close_clients(evicted)
+
+        try:
+            yield pooled.client
+        finally:
+            pooled.in_use -= 1
+            pooled.last_used = time.monotonic()
+
+    async def close(self):
+        """在应用关闭时调用，关闭所有客户端及其连接池"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        await self._close_clients(clients)
+
+
+llm_client_pool = LLMClientPool()
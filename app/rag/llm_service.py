@@ -1,35 +1,101 @@
 # services/chat_service.py
+import asyncio
 import json
+import time
 from typing import AsyncGenerator
 from app.db.mongo import get_mongo
 from app.models.conversation import UserMessage
-from openai import AsyncOpenAI
 
 from app.rag.mesage import find_depth_parent_mesage
 from app.core.logging import logger
 from app.db.milvus import milvus_client
-from app.rag.get_embedding import get_embeddings_from_httpx
+from app.rag.embedding_cache import query_embedding_cache
+from app.rag.llm_client import llm_client_pool
 from app.rag.utils import replace_image_content, sort_and_filter
 
 
+async def _timed(timings: dict, stage: str, coro):
+    """执行 coro 并把耗时（秒）记录到 timings[stage]"""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 4)
+
+
+def _cancel_tasks(*tasks):
+    """取消未完成的任务；已完成的任务取走异常，避免 "exception was never retrieved" """
+    for task in tasks:
+        if task is None:
+            continue
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
+
+
 class ChatService:
 
     @staticmethod
     async def create_chat_stream(
         user_message_content: UserMessage, message_id: str
     ) -> AsyncGenerator[str, None]:
-        """创建聊天流并处理存储逻辑"""
+        """
+        创建聊天流并处理存储逻辑
+        - 历史消息的加载与模型配置、查询 embedding 并发执行
+        - 只有需要检索知识库时才计算查询 embedding
+        - 记录各阶段耗时
+        """
         db = await get_mongo()
+        timings = {}
+        pipeline_start = time.perf_counter()
 
-        # 获取system prompt
-        model_config = await db.get_conversation_model_config(
-            user_message_content.conversation_id
+        # 历史消息不依赖模型配置，先开始加载
+        history_task = asyncio.create_task(
+            _timed(
+                timings,
+                "history",
+                find_depth_parent_mesage(
+                    user_message_content.conversation_id,
+                    user_message_content.parent_id,
+                    MAX_PARENT_DEPTH=5,
+                ),
+            )
         )
+        embedding_task = None
+        try:
+            # 获取system prompt
+            model_config = await _timed(
+                timings,
+                "model_config",
+                db.get_conversation_model_config(user_message_content.conversation_id),
+            )
+
+            # 处理用户上传的文件
+            bases = []
+            if user_message_content.temp_db:
+                bases.append({"baseId": user_message_content.temp_db})
+            bases.extend(model_config["base_used"])
+
+            # 确定需要检索知识库后立即计算查询 embedding，与历史消息加载并发
+            if bases:
+                embedding_task = asyncio.create_task(
+                    _timed(
+                        timings,
+                        "query_embedding",
+                        query_embedding_cache.get_query_embedding(
+                            user_message_content.user_message
+                        ),
+                    )
+                )
+            history_messages = await history_task
+            query_embedding = await embedding_task if embedding_task else None
+        finally:
+            _cancel_tasks(history_task, embedding_task)
 
         model_name = model_config["model_name"]
         model_url = model_config["model_url"]
         api_key = model_config["api_key"]
-        base_used = model_config["base_used"]
 
         system_prompt = model_config["system_prompt"]
         if len(system_prompt) > 1048576:
@@ -89,37 +155,30 @@ class ChatService:
             }
         ]
 
-        history_messages = await find_depth_parent_mesage(
-            user_message_content.conversation_id,
-            user_message_content.parent_id,
-            MAX_PARENT_DEPTH=5,
-        )
-
         for i in range(len(history_messages), 0, -1):
             messages.append(history_messages[i - 1])
 
-        # 处理用户上传的文件
-        content = []
-        bases = []
-        if user_message_content.temp_db:
-            bases.append({"baseId": user_message_content.temp_db})
-
         # 搜索知识库匹配内容
-
-        bases.extend(base_used)
+        content = []
         file_used = []
         if bases:
             result_score = []
-            query_embedding = await get_embeddings_from_httpx(
-                [user_message_content.user_message], endpoint="embed_text"
+            collection_names = [
+                f"colqwen{base['baseId'].replace('-', '_')}" for base in bases
+            ]
+            loop = asyncio.get_event_loop()
+            # 多个知识库的候选检索在 search_many 内并发执行
+            search_result = await _timed(
+                timings,
+                "search",
+                loop.run_in_executor(
+                    None,
+                    lambda: milvus_client.search_many(
+                        collection_names, data=query_embedding, topk=top_K
+                    ),
+                ),
             )
-            for base in bases:
-                collection_name = f"colqwen{base['baseId'].replace('-', '_')}"
-                if milvus_client.check_collection(collection_name):
-                    scores = milvus_client.search(
-                        collection_name, data=query_embedding[0], topk=top_K
-                    )
-                    result_score.extend(scores)
+            result_score.extend(search_result["results"])
             sorted_score = sort_and_filter(result_score, min_score=10)
             if len(sorted_score) >= top_K:
                 cut_score = sorted_score[:top_K]
@@ -127,23 +186,35 @@ class ChatService:
                 cut_score = sorted_score
 
             # 获取minio name并转成base64
-            for score in cut_score:
-                """
-                根据 file_id 和 image_id 获取：
-                - knowledge_db_id
-                - filename
-                - 文件的 minio_filename 和 minio_url
-                - 图片的 minio_filename 和 minio_url
-                """
-                file_and_image_info = await db.get_file_and_image_info(
-                    score["file_id"], score["image_id"]
-                )
+            # 根据 file_id 和 image_id 并发获取：
+            # - knowledge_db_id
+            # - filename
+            # - 文件的 minio_filename 和 minio_url
+            # - 图片的 minio_filename 和 minio_url
+            file_and_image_infos = await _timed(
+                timings,
+                "file_info",
+                asyncio.gather(
+                    *(
+                        db.get_file_and_image_info(score["file_id"], score["image_id"])
+                        for score in cut_score
+                    )
+                ),
+            )
+            for score, file_and_image_info in zip(cut_score, file_and_image_infos):
+                if file_and_image_info.get("status") != "success":
+                    # 文件已被删除等情况，跳过找不到元数据的页面
+                    logger.warning(
+                        f"Skip image {score['image_id']} of file {score['file_id']}: "
+                        f"{file_and_image_info.get('message')}"
+                    )
+                    continue
                 file_used.append(
                     {
                         "score": score["score"],
                         "knowledge_db_id": file_and_image_info["knowledge_db_id"],
                         "file_name": file_and_image_info["file_name"],
-                        "image_url": file_and_image_info["image_minio_url"],
+                        "image_url": file_and_image_info["image_preview_url"],
                         "file_url": file_and_image_info["file_minio_url"],
                     }
                 )
@@ -167,12 +238,12 @@ class ChatService:
             "content": content,
         }
         messages.append(user_message)
-        send_messages = await replace_image_content(messages)
-
-        client = AsyncOpenAI(
-            # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=api_key,
-            base_url=model_url,
+        send_messages = await _timed(
+            timings, "images", replace_image_content(messages)
+        )
+        timings["total"] = round(time.perf_counter() - pipeline_start, 4)
+        logger.info(
+            f"chat '{user_message_content.conversation_id}' stage timings: {timings}"
         )
 
         # 调用OpenAI API
@@ -185,75 +256,81 @@ class ChatService:
         if top_P != -1:
             optional_args["top_p"] = top_P  # 注意官方API参数名为top_p（小写p）
 
-        # 带条件参数的API调用
-        response = await client.chat.completions.create(
-            model=model_name,
-            messages=send_messages,
-            stream=True,
-            stream_options={"include_usage": True},
-            **optional_args,  # 展开条件参数
-        )
-
-        file_used_payload = json.dumps(
-            {
-                "type": "file_used",
-                "data": file_used,  # 这里直接使用已构建的 file_used 列表
-                "message_id": message_id,
-                "model_name": model_name,
-            }
-        )
-        yield f"data: {file_used_payload}\n\n"
+        # 复用该端点的客户端（连接池在多轮对话之间共享）
+        async with llm_client_pool.acquire(model_url, api_key) as client:
+            # 带条件参数的API调用
+            response = await client.chat.completions.create(
+                model=model_name,
+                messages=send_messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **optional_args,  # 展开条件参数
+            )
 
-        # 处理流响应
-        full_response = []
-        total_token = 0
-        completion_tokens = 0
-        prompt_tokens = 0
-        async for chunk in response:  # 直接迭代异步生成器
-            if chunk.choices:
-                delta = chunk.choices[0].delta
-                # 思考
-                if (
-                    hasattr(delta, "reasoning_content")
-                    and delta.reasoning_content != None
-                ):
-                    # 用JSON封装内容，自动处理换行符等特殊字符
-                    payload = json.dumps(
-                        {
-                            "type": "thinking",
-                            "data": delta.reasoning_content,
-                            "message_id": message_id,
-                        }
-                    )
-                    yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
-                # 回答
-                content = delta.content if delta else None
-                if content:
-                    # 用JSON封装内容，自动处理换行符等特殊字符
-                    payload = json.dumps(
-                        {"type": "text", "data": content, "message_id": message_id}
-                    )
-                    full_response.append(content)
-                    yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
-            else:
-                # token消耗
-                if hasattr(chunk, "usage") and chunk.usage != None:
-                    total_token = chunk.usage.total_tokens
-                    completion_tokens = chunk.usage.completion_tokens
-                    prompt_tokens = chunk.usage.prompt_tokens
-                    # 用JSON封装内容，自动处理换行符等特殊字符
-                    payload = json.dumps(
-                        {
-                            "type": "token",
-                            "total_token": total_token,
-                            "completion_tokens": completion_tokens,
-                            "prompt_tokens": prompt_tokens,
-                            "message_id": message_id,
-                        }
-                    )
-                    yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
+            # 客户端断开或出错时关闭响应流，把连接归还给共享的连接池
+            async with response:
+                file_used_payload = json.dumps(
+                    {
+                        "type": "file_used",
+                        "data": file_used,  # 这里直接使用已构建的 file_used 列表
+                        "message_id": message_id,
+                        "model_name": model_name,
+                    }
+                )
+                yield f"data: {file_used_payload}\n\n"
 
-        await client.close()
+                # 处理流响应
+                full_response = []
+                total_token = 0
+                completion_tokens = 0
+                prompt_tokens = 0
+                async for chunk in response:  # 直接迭代异步生成器
+                    if chunk.choices:
+                        delta = chunk.choices[0].delta
+                        # 思考
+                        if (
+                            hasattr(delta, "reasoning_content")
+                            and delta.reasoning_content != None
+                        ):
+                            # 用JSON封装内容，自动处理换行符等特殊字符
+                            payload = json.dumps(
+                                {
+                                    "type": "thinking",
+                                    "data": delta.reasoning_content,
+                                    "message_id": message_id,
+                                }
+                            )
+                            yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
+                        # 回答
+                        content = delta.content if delta else None
+                        if content:
+                            # 用JSON封装内容，自动处理换行符等特殊字符
+                            payload = json.dumps(
+                                {
+                                    "type": "text",
+                                    "data": content,
+                                    "message_id": message_id,
+                                }
+                            )
+                            full_response.append(content)
+                            yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
+                    else:
+                        # token消耗
+                        if hasattr(chunk, "usage") and chunk.usage != None:
+                            total_token = chunk.usage.total_tokens
+                            completion_tokens = chunk.usage.completion_tokens
+                            prompt_tokens = chunk.usage.prompt_tokens
+                            # 用JSON封装内容，自动处理换行符等特殊字符
+                            payload = json.dumps(
+                                {
+                                    "type": "token",
+                                    "total_token": total_token,
+                                    "completion_tokens": completion_tokens,
+                                    "prompt_tokens": prompt_tokens,
+                                    "message_id": message_id,
+                                }
+                            )
+                            yield f"data: {payload}\n\n"  # 保持SSE事件标准分隔符
 
         ai_message = {"role": "assistant", "content": "".join(full_response)}
         # 保存AI响应到mongodb
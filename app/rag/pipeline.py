@@ -0,0 +1,77 @@
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+# 队列结束标记
+DONE = object()
+
+
+async def run_stage(
+    handler: Callable[..., Awaitable],
+    in_queue: asyncio.Queue,
+    out_queue: Optional[asyncio.Queue],
+    concurrency: int = 1,
+):
+    """
+    流水线中的一个阶段
+    - concurrency 个 worker 并发从 in_queue 取数据并调用 handler
+    - handler 返回值（非 None）放入 out_queue，队列有界时自动形成背压
+    - 上游结束后向 out_queue 放入 DONE
+    """
+
+    async def worker():
+        while True:
+            item = await in_queue.get()
+            if item is DONE:
+                # 放回结束标记，让同阶段的其他 worker 也能退出
+                await in_queue.put(DONE)
+                return
+            result = await handler(item)
+            if out_queue is not None and result is not None:
+                await out_queue.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    if out_queue is not None:
+        await out_queue.put(DONE)
+
+
+async def run_batcher(
+    in_queue: asyncio.Queue,
+    out_queue: asyncio.Queue,
+    size: int,
+    max_weight: Optional[int] = None,
+    weight: Optional[Callable] = None,
+):
+    """
+    把单个元素攒成一批的列表，上游结束时输出剩余部分
+    - 每批最多 size 个元素
+    - 指定 max_weight 和 weight 时，每批的总权重（如字节数）不超过 max_weight
+    """
+    batch, batch_weight = [], 0
+    while True:
+        item = await in_queue.get()
+        if item is DONE:
+            break
+        item_weight = weight(item) if weight else 0
+        if batch and max_weight and batch_weight + item_weight > max_weight:
+            await out_queue.put(batch)
+            batch, batch_weight = [], 0
+        batch.append(item)
+        batch_weight += item_weight
+        if len(batch) >= size:
+            await out_queue.put(batch)
+            batch, batch_weight = [], 0
+    if batch:
+        await out_queue.put(batch)
+    await out_queue.put(DONE)
+
+
+async def run_pipeline(*stages: Awaitable):
+    """并发运行所有阶段，任一阶段失败时取消其余阶段"""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,64 @@
+# 在独立进程中执行的 PDF 栅格化函数，只依赖 pdf2image/PIL，保持导入轻量
+import os
+from io import BytesIO
+from typing import List, Optional, Tuple
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+# 页面图片编码格式: 格式名 -> (PIL 格式, Content-Type, 扩展名)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", ".png"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+}
+CONTENT_TYPES_BY_EXTENSION = {ext: ctype for _, ctype, ext in IMAGE_FORMATS.values()}
+CONTENT_TYPES_BY_EXTENSION[".jpeg"] = "image/jpeg"
+
+
+def content_type_for(filename: str) -> str:
+    """根据文件扩展名推断图片的 Content-Type，默认 image/png"""
+    extension = os.path.splitext(filename)[1].lower()
+    return CONTENT_TYPES_BY_EXTENSION.get(extension, "image/png")
+
+
+def encode_image(image, image_format: str, png_compress_level: int, quality: int):
+    buffer = BytesIO()
+    if image_format == "webp":
+        # 无损 WebP，method 越小编码越快
+        image.save(buffer, format="WEBP", lossless=True, method=1)
+    elif image_format == "jpeg":
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    else:
+        image.save(buffer, format="PNG", compress_level=png_compress_level)
+    return buffer.getvalue()
+
+
+def get_page_count(pdf_path: str) -> int:
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+
+def render_pages(
+    pdf_path: str,
+    first_page: int,
+    last_page: int,
+    image_format: str = "png",
+    png_compress_level: int = 1,
+    jpeg_quality: int = 90,
+    preview_max_edge: int = 0,
+    preview_quality: int = 75,
+) -> List[Tuple[bytes, Optional[bytes]]]:
+    """
+    渲染 [first_page, last_page] 范围内的页面（页码从 1 开始）
+    返回 (页面图片, 预览图) 列表，未开启预览时预览图为 None
+    """
+    images = convert_from_path(pdf_path, first_page=first_page, last_page=last_page)
+    pages = []
+    for image in images:
+        page = encode_image(image, image_format, png_compress_level, jpeg_quality)
+        preview = None
+        if preview_max_edge > 0:
+            # 缩略预览图，JPEG 编码，供前端展示使用
+            image.thumbnail((preview_max_edge, preview_max_edge))
+            preview = encode_image(image, "jpeg", png_compress_level, preview_quality)
+        image.close()
+        pages.append((page, preview))
+    return pages
@@ -1,11 +1,20 @@
 import asyncio
-import copy
 import uuid
+import numpy as np
 from app.db.milvus import milvus_client
+from app.db.page_vector_store import page_vector_store
 from app.db.mongo import get_mongo
-from app.rag.convert_file import convert_file_to_images, save_image_to_minio
+from app.rag.convert_file import (
+    iter_file_images,
+    page_image_format,
+    save_image_to_minio,
+)
 from app.rag.get_embedding import get_embeddings_from_httpx
+from app.rag.image_cache import page_image_cache
+from app.rag.pipeline import DONE, run_batcher, run_pipeline, run_stage
+from app.rag.rasterize import content_type_for
 from app.db.miniodb import async_minio_manager
+from app.core.config import settings
 from app.core.logging import logger
 
 
@@ -20,10 +29,6 @@ def sort_and_filter(data, min_score=None, max_score=None):
     return sorted_data
 
 
-async def update_task_progress(redis, task_id, status, message):
-    await redis.hset(f"task:{task_id}", mapping={"status": status, "message": message})
-
-
 async def handle_processing_error(redis, task_id, error_msg):
     await redis.hset(
         f"task:{task_id}", mapping={"status": "failed", "message": error_msg}
@@ -31,122 +36,323 @@ async def handle_processing_error(redis, task_id, error_msg):
 
 
 async def process_file(redis, task_id, username, knowledge_db_id, file_meta):
-    try:
-        # 从MinIO获取文件内容
-        file_content = await async_minio_manager.get_file_from_minio(
-            file_meta["minio_filename"]
-        )
+    """
+    解析单个文件并写入 MinIO / MongoDB / Milvus
+    - 失败时清理该文件已写入的部分数据并抛出异常，可以安全地重新调用
+    - 任务失败状态由调用方在放弃重试后标记
+    """
+    # 从MinIO获取文件内容
+    file_content = await async_minio_manager.get_file_from_minio(
+        file_meta["minio_filename"]
+    )
 
-        # 解析为图片
-        images_buffer = await convert_file_to_images(file_content)
+    # 流水线：栅格化 -> 上传 -> 生成嵌入 -> 插入Milvus
+    # 各阶段之间使用有界队列，第 N 页生成嵌入时第 N+1 页可以同时在栅格化
+    _, content_type, extension = page_image_format()
+    collection_name = f"colqwen{knowledge_db_id.replace('-', '_')}"
+    queue_size = settings.ingest_queue_size
+    upload_queue = asyncio.Queue(queue_size)
+    batch_queue = asyncio.Queue(queue_size)
+    embed_queue = asyncio.Queue(queue_size)
+    insert_queue = asyncio.Queue(queue_size)
+    db = await get_mongo()
 
-        # 保存图片并生成嵌入
-        image_ids = []
-        for i, image_buffer in enumerate(images_buffer):
-            # 保存图片到MinIO
-            minio_imagename, image_url = await save_image_to_minio(
-                username, file_meta["original_filename"], image_buffer
-            )
+    pages_total = 0
+    pages_done = 0
+    uploaded = []  # 已上传的页面图片，失败时删除
 
-            # 保存图片元数据
-            image_id = f"{username}_{uuid.uuid4()}"
-            db = await get_mongo()
-            await db.add_images(
-                file_id=file_meta["file_id"],
-                images_id=image_id,
-                minio_filename=minio_imagename,
-                minio_url=image_url,
-                page_number=i + 1,
+    async def on_page_count(page_count):
+        nonlocal pages_total
+        await redis.hincrby(f"task:{task_id}", "pages_total", page_count)
+        pages_total += page_count
+
+    async def rasterize():
+        async for i, image_buffer, preview_buffer in iter_file_images(
+            file_content, on_page_count
+        ):
+            await upload_queue.put(
+                {
+                    "index": i,
+                    "image_id": f"{username}_{uuid.uuid4()}",
+                    "image": image_buffer,
+                    "preview": preview_buffer,
+                }
             )
-            image_ids.append(image_id)
-        logger.info(
-            f"task:{task_id}: save images of {file_meta['original_filename']} to minio and mongodb"
+        await upload_queue.put(DONE)
+
+    async def upload_page(page):
+        # 保存图片到MinIO
+        minio_imagename, image_url = await save_image_to_minio(
+            username,
+            file_meta["original_filename"],
+            page["image"],
+            extension,
+            content_type,
         )
+        uploaded.append(minio_imagename)
+        image = {
+            "images_id": page["image_id"],
+            "minio_filename": minio_imagename,
+            "minio_url": image_url,
+            "page_number": page["index"] + 1,
+        }
+        if page["preview"] is not None:
+            preview_imagename, preview_url = await save_image_to_minio(
+                username,
+                file_meta["original_filename"],
+                page["preview"],
+                "_preview.jpg",
+                "image/jpeg",
+            )
+            uploaded.append(preview_imagename)
+            image["preview_minio_filename"] = preview_imagename
+            image["preview_minio_url"] = preview_url
+        page["record"] = image
+        return page
 
-        # 生成嵌入向量
+    async def embed_pages(pages):
         embeddings = await generate_embeddings(
-            images_buffer, file_meta["original_filename"]
-        )
-        logger.info(
-            f"task:{task_id}: {file_meta['original_filename']} generate_embeddings!"
+            [page["image"] for page in pages], file_meta["original_filename"]
         )
+        return pages, embeddings
 
-        # 插入Milvus
-        collection_name = f"colqwen{knowledge_db_id.replace('-', '_')}"
+    async def insert_pages(item):
+        nonlocal pages_done
+        pages, embeddings = item
+        # 先写页面元数据再插入向量，保证检索到的 image_id 在 MongoDB 中一定存在
+        await db.add_images_bulk(
+            file_id=file_meta["file_id"],
+            images=sorted(
+                (page["record"] for page in pages),
+                key=lambda image: image["page_number"],
+            ),
+        )
         await insert_to_milvus(
-            collection_name, embeddings, image_ids, file_meta["file_id"]
+            collection_name,
+            embeddings,
+            [page["image_id"] for page in pages],
+            file_meta["file_id"],
+            page_numbers=[page["index"] for page in pages],
         )
-        logger.info(
-            f"task:{task_id}: images of {file_meta['original_filename']} insert to milvus {collection_name}!"
+        # 按页更新进度
+        pages_done += len(pages)
+        await redis.hincrby(f"task:{task_id}", "pages_processed", len(pages))
+        # 只更新消息，不改写状态（同一任务的其他文件可能已将状态标记为失败）
+        await redis.hset(
+            f"task:{task_id}",
+            "message",
+            f"Processing {file_meta['original_filename']}: "
+            f"{pages_done} pages embedded",
         )
 
-        # 更新处理进度
-        await redis.hincrby(f"task:{task_id}", "processed", 1)
-        current = int(await redis.hget(f"task:{task_id}", "processed"))
-        total = int(await redis.hget(f"task:{task_id}", "total"))
-        logger.info(f"task:{task_id} files processed + 1!")
+    try:
+        await run_pipeline(
+            rasterize(),
+            run_stage(
+                upload_page,
+                upload_queue,
+                batch_queue,
+                settings.minio_upload_concurrency,
+            ),
+            # 按页数和字节数切分 embed_image 请求，失败时只重试对应分块
+            run_batcher(
+                batch_queue,
+                embed_queue,
+                settings.ingest_embed_batch_pages,
+                max_weight=settings.ingest_embed_batch_bytes,
+                weight=lambda page: page["image"].getbuffer().nbytes,
+            ),
+            run_stage(
+                embed_pages,
+                embed_queue,
+                insert_queue,
+                settings.ingest_embed_concurrency,
+            ),
+            run_stage(
+                insert_pages, insert_queue, None, settings.ingest_insert_concurrency
+            ),
+        )
+    except BaseException:
+        # 清理已写入的部分数据，避免检索到未处理完的文件的页面，重试时也不会重复写入
+        await cleanup_partial_file(
+            redis,
+            task_id,
+            collection_name,
+            file_meta["file_id"],
+            uploaded,
+            pages_total,
+            pages_done,
+        )
+        raise
+    del file_content
 
-        if current == total:
-            await redis.hset(f"task:{task_id}", "status", "completed")
-            await redis.hset(
-                f"task:{task_id}", "message", "All files processed successfully"
-            )
-            logger.info(f"task:{task_id} All files processed successfully")
+    logger.info(
+        f"task:{task_id}: {pages_done} pages of {file_meta['original_filename']} "
+        f"saved to minio/mongodb and inserted to milvus {collection_name}!"
+    )
 
+    # 更新处理进度
+    await redis.hincrby(f"task:{task_id}", "processed", 1)
+    current = int(await redis.hget(f"task:{task_id}", "processed"))
+    total = int(await redis.hget(f"task:{task_id}", "total"))
+    logger.info(f"task:{task_id} files processed + 1!")
+
+    if current == total:
+        await redis.hset(f"task:{task_id}", "status", "completed")
+        await redis.hset(
+            f"task:{task_id}", "message", "All files processed successfully"
+        )
+        logger.info(f"task:{task_id} All files processed successfully")
+
+
+async def delete_file_vectors(collection_name, file_id):
+    """删除文件在 Milvus 和本地页面向量存储中的所有向量"""
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(
+            None, milvus_client.delete_files, collection_name, [file_id]
+        )
     except Exception as e:
-        await handle_processing_error(
-            redis, task_id, f"File processing failed: {str(e)}"
+        logger.error(
+            f"Delete vectors of file {file_id} in {collection_name} failed: {e}"
         )
-        raise
+
+
+async def cleanup_partial_file(
+    redis, task_id, collection_name, file_id, minio_filenames, pages_total, pages_done
+):
+    """清理处理失败的文件已写入的部分数据：向量、页面记录、页面图片和页数进度"""
+    await delete_file_vectors(collection_name, file_id)
+    try:
+        db = await get_mongo()
+        await db.clear_file_images(file_id)
+    except Exception as e:
+        logger.error(f"Clear page records of file {file_id} failed: {e}")
+    try:
+        await async_minio_manager.bulk_delete(minio_filenames)
+    except Exception as e:
+        logger.error(f"Delete page images of file {file_id} failed: {e}")
+    try:
+        await redis.hincrby(f"task:{task_id}", "pages_total", -pages_total)
+        await redis.hincrby(f"task:{task_id}", "pages_processed", -pages_done)
+    except Exception as e:
+        logger.error(f"Reset page progress of task {task_id} failed: {e}")
 
 
 async def generate_embeddings(images_buffer, filename):
     # 将同步函数包装到线程池执行
+    _, content_type, extension = page_image_format()
     images_request = [
-        ("images", (f"{filename}_{i}.png", img, "image/png"))
+        ("images", (f"{filename}_{i}{extension}", img, content_type))
         for i, img in enumerate(images_buffer)
     ]
     return await get_embeddings_from_httpx(images_request, endpoint="embed_image")
 
 
-async def insert_to_milvus(collection_name, embeddings, image_ids, file_id):
+async def insert_to_milvus(
+    collection_name, embeddings, image_ids, file_id, page_numbers=None
+):
+    # 整个文件的 embedding 拼成一个连续矩阵，按页偏移量列式批量插入
+    page_offsets = np.zeros(len(embeddings) + 1, dtype=np.int64)
+    page_offsets[1:] = np.cumsum([len(emb) for emb in embeddings])
+    vectors = (
+        np.concatenate(embeddings).astype(np.float32, copy=False)
+        if len(embeddings)
+        else np.zeros((0, 0), dtype=np.float32)
+    )
     loop = asyncio.get_event_loop()
+    await loop.run_in_executor(
+        None,
+        lambda: milvus_client.insert_bulk(
+            collection_name,
+            vectors,
+            page_offsets,
+            image_ids,
+            page_numbers or list(range(len(embeddings))),
+            file_id,
+        ),
+    )
+    # 同时写入本地页面向量存储，重排时无需再从 Milvus 拉取向量
     await loop.run_in_executor(
         None,
         lambda: [
-            milvus_client.insert(
-                {
-                    "colqwen_vecs": emb,
-                    "page_number": i,
-                    "image_id": image_ids[i],
-                    "file_id": file_id,
-                },
-                collection_name,
-            )
+            page_vector_store.put(collection_name, file_id, image_ids[i], emb)
             for i, emb in enumerate(embeddings)
         ],
     )
 
 
+def _is_image_item(item) -> bool:
+    return (
+        isinstance(item, dict)
+        and item.get("type") == "image_url"
+        and isinstance(item.get("image_url"), str)
+    )
+
+
 async def replace_image_content(messages):
+    """
+    把消息中 image_url 引用的 MinIO 文件替换为 base64 data URL
+    - 所有图片并发下载（并发数受限），同一图片只下载一次
+    - 热点页面图片命中缓存时不再访问 MinIO
+    - 只复制需要修改的消息，原始消息保持不变
+    """
+    # 收集所有需要下载的图片（去重）
+    file_names = list(
+        dict.fromkeys(
+            item["image_url"]
+            for message in messages
+            if isinstance(message.get("content"), list)
+            for item in message["content"]
+            if _is_image_item(item)
+        )
+    )
 
-    # 创建深拷贝以保证原始数据不变
-    new_messages = copy.deepcopy(messages)
-    # 遍历每条消息
-    for message in new_messages:
-        if "content" not in message:
-            continue
+    semaphore = asyncio.Semaphore(settings.prompt_image_fetch_concurrency)
 
-        # 遍历content中的每个内容项
-        for item in message["content"]:
-            if isinstance(item, dict):
-                # 检查类型是否为image_url
-                if item.get("type") == "image_url":
-                    image_base64 = (
-                        await async_minio_manager.download_image_and_convert_to_base64(
-                            item["image_url"]
-                        )
-                    )
-                    item["image_url"] = {"url": f"data:image/png;base64,{image_base64}"}
+    async def download(file_name):
+        async with semaphore:
+            return await async_minio_manager.download_image_as_data_url(
+                file_name, content_type_for(file_name)
+            )
+
+    async def fetch(file_name):
+        # 热点页面直接从缓存取，未命中时才下载
+        return await page_image_cache.get_or_fetch(
+            file_name, lambda: download(file_name)
+        )
 
+    data_urls = dict(
+        zip(file_names, await asyncio.gather(*(fetch(name) for name in file_names)))
+    )
+    if file_names:
+        logger.info(
+            f"Page image cache hit rate {page_image_cache.hit_rate():.2%} "
+            f"| {page_image_cache.stats}"
+        )
+
+    new_messages = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list) or not any(
+            _is_image_item(item) for item in content
+        ):
+            new_messages.append(message)
+            continue
+        new_messages.append(
+            {
+                **message,
+                "content": [
+                    (
+                        {
+                            **item,
+                            "image_url": {"url": data_urls[item["image_url"]]},
+                        }
+                        if _is_image_item(item)
+                        else item
+                    )
+                    for item in content
+                ],
+            }
+        )
     return new_messages
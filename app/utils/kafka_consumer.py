@@ -1,36 +1,61 @@
+import asyncio
 import json
-from aiokafka import AIOKafkaConsumer, ConsumerRecord
+from collections import defaultdict
+from aiokafka import AIOKafkaConsumer, ConsumerRecord, TopicPartition
 from app.core.config import settings
 from app.core.logging import logger
-from asyncio import Lock
+from asyncio import Lock, Semaphore
 from app.db.redis import redis
-from app.rag.utils import process_file, update_task_progress
+from app.rag.utils import handle_processing_error, process_file
 
 KAFKA_TOPIC = settings.kafka_topic
+KAFKA_PRIORITY_TOPIC = settings.kafka_priority_topic
 KAFKA_BOOTSTRAP_SERVERS = settings.kafka_broker_url
 KAFKA_PRIORITY_HEADER = "priority"
 KAFKA_GROUP_ID = settings.kafka_group_id
+KAFKA_PRIORITY_GROUP_ID = settings.kafka_priority_group_id
 
 
 class KafkaConsumerManager:
-    def __init__(self):
+    def __init__(
+        self,
+        topic: str = KAFKA_TOPIC,
+        lane: str = "normal",
+        max_in_flight: int = settings.kafka_max_in_flight,
+        group_id: str = KAFKA_GROUP_ID,
+    ):
+        self.topic = topic
+        self.group_id = group_id  # 每个通道使用独立的消费组
+        self.lane = lane  # 优先级通道名称
+        self.max_in_flight = max_in_flight
         self.consumer = None
         self.lock = Lock()  # 初始化锁
         self.lock_name = "kafka_message_lock"  # Redis锁的名称
+        self.in_flight = Semaphore(max_in_flight)  # 并发处理的消息数
+        self.tasks = set()  # 处理中的消息任务
+        self.consume_task = None  # 拉取消息的任务
+        self.partition_tails = {}  # 每个分区最后一条消息的处理任务（分区内顺序处理）
+        self.in_flight_offsets = defaultdict(set)  # 每个分区处理中的 offset
+        self.max_done_offsets = {}  # 每个分区已处理完成的最大 offset
+        self.committed_offsets = {}  # 每个分区已提交的 offset
 
     async def start(self):
         if not self.consumer:
             self.consumer = AIOKafkaConsumer(
-                KAFKA_TOPIC,
+                self.topic,
                 bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
-                group_id=KAFKA_GROUP_ID,
+                group_id=self.group_id,
                 enable_auto_commit=False,  # 手动提交消息、
+                # 处理耗时较长时避免被踢出消费组
+                max_poll_interval_ms=settings.kafka_max_poll_interval_ms,
             )
             await self.consumer.start()
 
     async def stop(self):
+        await self.drain()
         if self.consumer:
             await self.consumer.stop()
+            self.consumer = None
 
     async def process_message(self, msg: ConsumerRecord):
         
@@ -41,10 +66,13 @@ class KafkaConsumerManager:
         knowledge_db_id = message["knowledge_db_id"]
         file_meta = message["file_meta"]
         redis_connection = await redis.get_task_connection()
-        # 更新任务状态
-        await update_task_progress(redis_connection, task_id, "processing", 
-            f"Processing {file_meta['original_filename']}...")
-        
+        # 只更新消息，不改写状态（同一任务的其他文件可能已将状态标记为失败）
+        await redis_connection.hset(
+            f"task:{task_id}",
+            "message",
+            f"Processing {file_meta['original_filename']}...",
+        )
+
         # 处理文件
         await process_file(
             redis=redis_connection,
@@ -54,47 +82,223 @@ class KafkaConsumerManager:
             file_meta=file_meta
         )
 
+    async def _process_with_retry(self, msg: ConsumerRecord):
+        # 失败的消息重试若干次后放弃并标记任务失败，避免毒消息一直阻塞该分区的 offset 提交
+        # （process_file 失败时会清理该文件已写入的部分数据，重试不会重复写入）
+        error = None
+        for attempt in range(settings.kafka_max_retries + 1):
+            try:
+                await self.process_message(msg)
+                return
+            except Exception as e:
+                error = e
+                logger.error(
+                    f"Error processing message {msg.topic}-{msg.partition}@{msg.offset} "
+                    f"(attempt {attempt + 1}): {e}"
+                )
+        logger.error(
+            f"Give up message {msg.topic}-{msg.partition}@{msg.offset} "
+            f"after {settings.kafka_max_retries + 1} attempts"
+        )
+        try:
+            message = json.loads(msg.value.decode("utf-8"))
+            redis_connection = await redis.get_task_connection()
+            await handle_processing_error(
+                redis_connection,
+                message["task_id"],
+                f"File processing failed: {str(error)}",
+            )
+        except Exception as e:
+            logger.error(f"Mark task failed for message {msg.offset} error: {e}")
+
+    async def _handle_message(self, msg: ConsumerRecord, previous=None):
+        if previous is not None:
+            # 等待同一分区的上一条消息处理完成
+            await asyncio.wait([previous])
+
+        message_id = f"{msg.topic}:{msg.partition}:{msg.offset}"
+        redis_connection = await redis.get_task_connection()  # 获取 Redis 连接实例
+        lock_key = f"{self.lock_name}:{message_id}"  # 使用分区+偏移量创建唯一的锁名
+
+        # 检查锁是否存在
+        if await redis_connection.exists(lock_key):
+            logger.info(
+                f"Message {message_id} is already being processed by another instance."
+            )
+            return
+
+        lock = redis_connection.lock(
+            lock_key, timeout=settings.kafka_message_lock_timeout
+        )
+        if await lock.acquire(blocking=False):  # 尝试非阻塞获取锁
+            try:
+                await self._process_with_retry(msg)
+            finally:
+                try:
+                    await lock.release()  # 释放锁
+                except Exception as e:
+                    logger.warning(f"Release lock {lock_key} failed: {e}")
+        else:
+            logger.info(
+                f"Message {message_id} is already being processed by another instance."
+            )
+
+    def _release_partition_tail(self, tp: TopicPartition, task: asyncio.Task):
+        if self.partition_tails.get(tp) is task:
+            del self.partition_tails[tp]
+
+    def _track(self, msg: ConsumerRecord):
+        tp = TopicPartition(msg.topic, msg.partition)
+        self.in_flight_offsets[tp].add(msg.offset)
+
+    async def _mark_done(self, msg: ConsumerRecord):
+        """
+        标记消息处理完成，并提交该分区可以安全提交的 offset
+        （并发处理时后面的消息可能先完成，只能提交到最早未完成的消息之前）
+        """
+        tp = TopicPartition(msg.topic, msg.partition)
+        in_flight = self.in_flight_offsets[tp]
+        in_flight.discard(msg.offset)
+        self.max_done_offsets[tp] = max(self.max_done_offsets.get(tp, -1), msg.offset)
+        commit_offset = min(in_flight) if in_flight else self.max_done_offsets[tp] + 1
+        if commit_offset <= self.committed_offsets.get(tp, -1):
+            return
+        try:
+            await self.consumer.commit({tp: commit_offset})
+            self.committed_offsets[tp] = commit_offset
+        except Exception as e:
+            # 分区被重新分配时提交会失败，消息会被新的消费者重新处理
+            logger.warning(f"Commit {tp} offset {commit_offset} failed: {e}")
+
+    async def _run_message(self, msg: ConsumerRecord, previous=None):
+        try:
+            await self._handle_message(msg, previous)
+        finally:
+            self.in_flight.release()
+            await self._mark_done(msg)
+
     # @retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
     async def consume_messages(self):
-        """持续消费Kafka消息."""
+        """
+        持续消费Kafka消息
+        - 最多同时处理 max_in_flight 条消息
+        - 处理完成后才提交 offset（按分区连续提交）
+        - stop() 时停止拉取新消息，并等待处理中的消息完成
+        """
         await self.start()
+        self.in_flight = Semaphore(self.max_in_flight)
+        self.consume_task = asyncio.current_task()
         try:
             async for msg in self.consumer:  # 异步循环消费消息
-                logger.info("kafka start consume")
-                message_id = msg.offset  # 使用消息的偏移量作为唯一标识
-                redis_connection = (
-                    await redis.get_task_connection()
-                )  # 获取 Redis 连接实例
-
-                lock_key = f"{self.lock_name}:{message_id}"  # 使用偏移量创建唯一的锁名
-
-                # 检查锁是否存在
-                is_locked = await redis_connection.exists(lock_key)
-                if is_locked:
-                    # 如果锁存在，直接进入 else 分支
-                    logger.info(
-                        f"Message {message_id} is already being processed by another instance."
+                await self.in_flight.acquire()
+                priority = dict(msg.headers or []).get(KAFKA_PRIORITY_HEADER, b"")
+                logger.info(
+                    f"kafka start consume, lane {self.lane}, "
+                    f"priority {priority.decode('utf-8', 'ignore')}"
+                )
+                self._track(msg)
+                if settings.kafka_partition_ordering:
+                    # 在拉取消息时（任何 await 之前）就按 offset 排好同一分区的处理顺序
+                    tp = TopicPartition(msg.topic, msg.partition)
+                    task = asyncio.create_task(
+                        self._run_message(msg, self.partition_tails.get(tp))
                     )
-                    continue  # 直接跳过此消息，继续处理下一个消息
-
-                lock = redis_connection.lock(lock_key, timeout=100)  # 创建锁
-
-                if await lock.acquire(blocking=False):  # 尝试非阻塞获取锁
-                    try:
-                        await self.consumer.commit()  # 手动提交消息，确保处理成功才提交
-                        await self.process_message(msg)  # 处理每条消息
-                    except Exception as e:
-                        logger.error(f"Error processing message: {e}")
-                    finally:
-                        await lock.release()  # 释放锁
-                else:
-                    logger.info(
-                        f"Message {message_id} is already being processed by another instance."
+                    self.partition_tails[tp] = task
+                    task.add_done_callback(
+                        lambda t, tp=tp: self._release_partition_tail(tp, t)
                     )
-
+                else:
+                    task = asyncio.create_task(self._run_message(msg))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except asyncio.CancelledError:
+            logger.info("Kafka consumer stops fetching new messages")
         except Exception as e:
             logger.error(f"Error consuming messages: {e}")
             raise e
 
+    async def drain(self, timeout: float = None):
+        """停止拉取新消息，等待处理中的消息完成"""
+        if self.consume_task and not self.consume_task.done():
+            self.consume_task.cancel()
+            await asyncio.gather(self.consume_task, return_exceptions=True)
+        if self.tasks:
+            logger.info(f"Draining {len(self.tasks)} in-flight kafka messages")
+            _, not_done = await asyncio.wait(
+                list(self.tasks), timeout=timeout or settings.kafka_drain_timeout
+            )
+            if not_done:
+                logger.warning(
+                    f"{len(not_done)} kafka messages still in-flight after drain timeout"
+                )
+
+    async def lane_depth(self) -> int:
+        """通道积压深度：已分配分区的未拉取消息数 + 处理中的消息数"""
+        depth = len(self.tasks)
+        if not self.consumer:
+            return depth
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if highwater is None:
+                continue
+            try:
+                position = await self.consumer.position(tp)
+            except Exception:
+                continue
+            depth += max(0, highwater - position)
+        return depth
+
+
+class KafkaConsumerLanes:
+    """
+    多优先级通道消费
+    - 每个通道对应一个 topic 和独立的 KafkaConsumerManager，处理槽位互不占用
+    - 每个通道使用独立的消费组，一个通道的重平衡不会收回另一个通道的分区
+    - 高优先级通道（会话临时文件）不会排在批量导入的知识库文件之后
+    - 定期输出各通道的积压深度
+    """
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.metrics_task = None
+
+    async def lane_depths(self) -> dict:
+        return {lane.lane: await lane.lane_depth() for lane in self.lanes}
+
+    async def _report_lane_depths(self):
+        while True:
+            await asyncio.sleep(settings.kafka_lane_metrics_interval)
+            try:
+                logger.info(f"Kafka lane depths: {await self.lane_depths()}")
+            except Exception as e:
+                logger.warning(f"Collect kafka lane depths failed: {e}")
+
+    async def consume_messages(self):
+        self.metrics_task = asyncio.create_task(self._report_lane_depths())
+        tasks = [asyncio.create_task(lane.consume_messages()) for lane in self.lanes]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # 任一通道异常退出时同时停止其他通道
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.metrics_task.cancel()
+
+    async def stop(self):
+        if self.metrics_task:
+            self.metrics_task.cancel()
+        await asyncio.gather(*(lane.stop() for lane in self.lanes))
+
 
-kafka_consumer_manager = KafkaConsumerManager()
+kafka_consumer_manager = KafkaConsumerLanes(
+    [
+        KafkaConsumerManager(
+            KAFKA_PRIORITY_TOPIC,
+            "high",
+            settings.kafka_priority_max_in_flight,
+            KAFKA_PRIORITY_GROUP_ID,
+        ),
+        KafkaConsumerManager(KAFKA_TOPIC, "normal", settings.kafka_max_in_flight),
+    ]
+)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from aiokafka import AIOKafkaProducer
 from aiokafka.errors import KafkaError
@@ -5,8 +6,15 @@ from app.core.config import settings
 from app.core.logging import logger
 
 KAFKA_TOPIC = settings.kafka_topic
+KAFKA_PRIORITY_TOPIC = settings.kafka_priority_topic
 KAFKA_BOOTSTRAP_SERVERS = settings.kafka_broker_url
 KAFKA_PRIORITY_HEADER = "priority"
+KAFKA_PRIORITY_HIGH = 0  # 0为最高优先级，走高优先级通道
+
+
+def topic_for_priority(priority) -> str:
+    """高优先级任务（会话临时文件）发送到独立的 topic"""
+    return KAFKA_PRIORITY_TOPIC if int(priority) <= KAFKA_PRIORITY_HIGH else KAFKA_TOPIC
 
 
 class KafkaProducerManager:
@@ -15,7 +23,12 @@ class KafkaProducerManager:
 
     async def start(self):
         if not self.producer:
-            self.producer = AIOKafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS)
+            self.producer = AIOKafkaProducer(
+                bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                linger_ms=settings.kafka_linger_ms,  # 攒批发送
+                compression_type=settings.kafka_compression_type,
+                max_batch_size=settings.kafka_max_batch_size,
+            )
             await self.producer.start()
 
     async def stop(self):
@@ -42,7 +55,7 @@ class KafkaProducerManager:
         try:
             await self.start()
             await self.producer.send(
-                KAFKA_TOPIC,
+                topic_for_priority(priority),
                 json.dumps(message).encode("utf-8"),
                 headers=[
                     (KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))
@@ -52,5 +65,43 @@ class KafkaProducerManager:
         except KafkaError as e:
             logger.error(f"Error sending message to Kafka: {e}")
 
+    async def send_embedding_tasks(
+        self,
+        task_id: str,
+        username: str,
+        knowledge_db_id: str,
+        file_metas: list,
+        priority: str,
+    ):
+        """批量发送同一次上传的所有文件任务，只等待一次全部确认"""
+        if not file_metas:
+            return
+        topic = topic_for_priority(priority)
+        headers = [(KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))]
+        try:
+            await self.start()
+            futures = []
+            for file_meta in file_metas:
+                message = {
+                    "task_id": task_id,
+                    "username": username,
+                    "knowledge_db_id": knowledge_db_id,
+                    "file_meta": file_meta,
+                }
+                # send 只把消息放入发送缓冲区，返回确认用的 future
+                futures.append(
+                    await self.producer.send(
+                        topic, json.dumps(message).encode("utf-8"), headers=headers
+                    )
+                )
+            await self.producer.flush()
+            await asyncio.gather(*futures)
+            logger.info(
+                f"Task {task_id}: {len(file_metas)} messages sent to Kafka topic "
+                f"{topic} with priority: {priority}"
+            )
+        except KafkaError as e:
+            logger.error(f"Error sending messages to Kafka: {e}")
+
 
 kafka_producer_manager = KafkaProducerManager()
@@ -0,0 +1,64 @@
+# 独立的文件解析（ingestion）worker：python -m app.worker
+# 只运行 Kafka 消费者，不处理 API 请求，可与 API 服务分开扩容
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.config import settings
+from app.core.logging import logger
+
+
+async def run_worker():
+    # 栅格化进程池以 spawn 方式启动，子进程会重新导入本模块（__mp_main__），
+    # 数据库、Kafka 等重量级依赖放在函数内导入，避免每个子进程都去连接 Milvus 等服务
+    from app.db.miniodb import async_minio_manager
+    from app.db.mongo import mongodb
+    from app.db.redis import redis
+    from app.rag.get_embedding import model_server_client
+    from app.utils.kafka_consumer import kafka_consumer_manager
+
+    loop = asyncio.get_running_loop()
+    # Milvus 插入、本地向量写入等阻塞操作使用的线程池
+    loop.set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=settings.worker_thread_pool_size,
+            thread_name_prefix="ingest",
+        )
+    )
+
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await mongodb.connect()  # 连接 MongoDB
+    await async_minio_manager.init_minio()
+    await model_server_client.start()  # 启动 model_server 连接池
+
+    consume_task = asyncio.create_task(kafka_consumer_manager.consume_messages())
+    # 只输出非敏感配置
+    logger.info(
+        f"Ingestion worker started | topics: {settings.kafka_priority_topic}, "
+        f"{settings.kafka_topic} | groups: {settings.kafka_priority_group_id}, "
+        f"{settings.kafka_group_id} "
+        f"| max in-flight: {settings.kafka_priority_max_in_flight}/"
+        f"{settings.kafka_max_in_flight} | model servers: {settings.model_server_urls}"
+    )
+
+    # 收到退出信号或消费者异常退出时停止
+    stop_task = asyncio.create_task(stop_event.wait())
+    await asyncio.wait([consume_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+    stop_task.cancel()
+
+    await kafka_consumer_manager.stop()  # 停止Kafka消费者（等待处理中的消息完成）
+    await model_server_client.close()  # 关闭 model_server 连接池
+    await mongodb.close()  # 关闭 MongoDB 连接
+    await async_minio_manager.close()  # 关闭 MinIO 客户端
+    await redis.close()  # 关闭 Redis 连接
+    logger.info("Ingestion worker stopped")
+
+    if consume_task.done() and not consume_task.cancelled():
+        consume_task.result()  # 消费者异常退出时抛出异常
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
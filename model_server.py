@@ -1,24 +1,154 @@
 # 新建文件 app/core/model_server.py
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from io import BytesIO
 from typing import List
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Request, Response, UploadFile
+from app.core.config import settings
+from app.core.logging import logger
 from app.rag.colbert_service import colbert
+import numpy as np
 import uvicorn
 from pydantic import BaseModel
 from PIL import Image
 
-app = FastAPI()
 service = colbert  # 单实例加载
+# 模型推理放到单独的线程中执行（单线程保证 GPU 串行使用），不阻塞事件循环
+model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="colbert")
+
+
+class QueryBatcher:
+    """
+    查询 embedding 微批处理
+    - 并发请求先进入队列，最多等待 max_wait_ms 或凑满 max_batch_size 条查询
+    - 合并为一个批次在模型线程中推理，再把结果分发回各个请求
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = None
+        self.task: asyncio.Task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, queries: list) -> List[np.ndarray]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((queries, future))
+        return await future
+
+    async def _collect(self):
+        # 阻塞等待第一个请求，随后在时间窗口内尽量多地收集请求
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            queries = [query for item_queries, _ in batch for query in item_queries]
+            try:
+                embeddings = await loop.run_in_executor(
+                    model_executor, service.process_query, queries
+                )
+            except Exception as e:
+                logger.exception(f"embed_text batch of {len(queries)} failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for item_queries, future in batch:
+                end = start + len(item_queries)
+                if not future.done():
+                    future.set_result(embeddings[start:end])
+                start = end
+
+
+query_batcher = QueryBatcher(
+    max_batch_size=settings.embed_text_max_batch_size,
+    max_wait_ms=settings.embed_text_max_wait_ms,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await query_batcher.start()
+    yield
+    await query_batcher.stop()
+    model_executor.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# 二进制响应格式：所有 embedding 按行拼接成一个连续缓冲区，
+# 形状信息放在响应头中，客户端用 np.frombuffer 零拷贝解码
+BINARY_MEDIA_TYPE = "application/octet-stream"
+BINARY_DTYPES = ("float16", "float32")
+
 
 class TextRequest(BaseModel):
     queries: list  # 显式定义字段
 
+
+def embeddings_response(request: Request, embeddings: List[np.ndarray]):
+    """根据 Accept 头返回 JSON 或二进制格式的 embedding"""
+    if BINARY_MEDIA_TYPE not in request.headers.get("accept", ""):
+        return {"embeddings": [embedding.tolist() for embedding in embeddings]}
+
+    dtype = request.headers.get("x-embedding-dtype", "float16")
+    if dtype not in BINARY_DTYPES:
+        dtype = "float16"
+    dim = embeddings[0].shape[1] if embeddings else 0
+    buffer = (
+        np.concatenate(embeddings).astype(dtype, copy=False).tobytes()
+        if embeddings
+        else b""
+    )
+    return Response(
+        content=buffer,
+        media_type=BINARY_MEDIA_TYPE,
+        headers={
+            "X-Embedding-Dtype": dtype,
+            "X-Embedding-Dim": str(dim),
+            "X-Embedding-Lengths": ",".join(str(len(e)) for e in embeddings),
+        },
+    )
+
+
 @app.post("/embed_text")
-async def embed_text(request: TextRequest):
-    return {"embeddings": service.process_query(request.queries)}
+async def embed_text(request: Request, text_request: TextRequest):
+    embeddings = await query_batcher.submit(text_request.queries)
+    return embeddings_response(request, embeddings)
+
 
 @app.post("/embed_image")
-async def embed_image(images: List[UploadFile] = File(...)):
+async def embed_image(request: Request, images: List[UploadFile] = File(...)):
     pil_images = []
     for image_file in images:
         # 读取二进制流并转为 PIL.Image
@@ -28,10 +158,12 @@ async def embed_image(images: List[UploadFile] = File(...)):
         pil_images.append(image)
         # 重要：关闭文件流避免内存泄漏
         await image_file.close()
-    return {"embeddings": service.process_image(pil_images)}
+    loop = asyncio.get_running_loop()
+    embeddings = await loop.run_in_executor(
+        model_executor, service.process_image, pil_images
+    )
+    return embeddings_response(request, embeddings)
 
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8005)
-
-